@@ -22,12 +22,22 @@ import sys
 import imp
 import os
 import pymysql as sql
-import codecs
 import requests
+import requests.adapters
+import threading
+import Queue
 import base64
 import struct
 import socket
 import json
+import time
+import itertools
+import collections
+import hashlib
+import sqlite3
+import argparse
+import random
+import atexit
 
 try:
     requests.packages.urllib3.disable_warnings()
@@ -36,13 +46,37 @@ except:
 
 conf = imp.load_source('conf', 'conf')
 
+# per-thread state: name of the phase the thread is working for
+context = threading.local()
+
 
 class Logger:
+    """
+    Messages are queued and written by a background thread in batches. Files stay open and are flushed
+    when the queue runs empty, at least every LOG_FLUSH_INTERVAL seconds, and at exit.
+    Messages below LOG_LEVEL are dropped. Request and response bodies are logged at debug level
+    and cut to LOG_BODY_LIMIT characters.
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+    BATCH_SIZE = 1000  # max. number of messages written at once
+
     def __init__(self, logfile, stdout):
         print '[!] Version %s' % __version__
         self.logfile = logfile
         self.stdout = stdout
+        self.level = self.LEVELS[str(getattr(conf, 'LOG_LEVEL', 'debug')).lower()]
+        self.body_limit = int(getattr(conf, 'LOG_BODY_LIMIT', 0))
+        self.flush_interval = float(getattr(conf, 'LOG_FLUSH_INTERVAL', 1))
         self.check_log_file()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.worker, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
 
     def check_log_file(self):
         while 1:
@@ -60,99 +94,1087 @@ class Logger:
             with open(conf.DEBUG_LOG, 'w'):
                 pass
 
-    def writer(self, msg):
-        if conf.LOGFILE and conf.LOGFILE != '':
-            with codecs.open(self.logfile, 'a', encoding='utf-8') as f:
+    def writer(self, msg, level=INFO):
+        if level >= self.level:
+            self.queue.put(('log', msg))
+
+    def body(self, msg):
+        """
+        Log a request or response body, cut to LOG_BODY_LIMIT characters.
+        """
+        if self.DEBUG < self.level:
+            return
+        if not isinstance(msg, basestring):
+            msg = unicode(msg)
+        if self.body_limit and len(msg) > self.body_limit:
+            msg = msg[:self.body_limit] + ' ... (%d characters)' % len(msg)
+        self.queue.put(('log', msg))
+
+    def debugger(self, msg):
+        if conf.DEBUG_LOG and conf.DEBUG_LOG != '':
+            title, message = msg
+            row = '\n-----------------------------------------------------\n%s\n%s' % (title, message)
+            self.queue.put(('debug', row + '\r\n'))
+
+    def debug_line(self, msg):
+        if conf.DEBUG_LOG and conf.DEBUG_LOG != '':
+            self.queue.put(('debug', msg))
+
+    @staticmethod
+    def encode(msg):
+        if isinstance(msg, unicode):
+            return msg.encode('UTF-8')
+        return msg
+
+    def echo(self, msg):
+        try:
+            print msg
+        except:
+            if isinstance(msg, str):
                 msg = msg.decode('UTF-8', 'ignore')
-                f.write(msg + '\r\n')  # \r\n for notepad
-        if self.stdout:
+            print msg.encode('ascii', 'ignore') + ' # < non-ASCII chars detected! >'
+
+    def write_batch(self, batch, files):
+        lines = {'log': [], 'debug': []}
+        for kind, msg in batch:
+            lines[kind].append(self.encode(msg) + '\r\n')  # \r\n for notepad
+            if kind == 'log' and self.stdout:
+                self.echo(msg)
+        for kind, filename in (('log', conf.LOGFILE and self.logfile), ('debug', conf.DEBUG_LOG)):
+            if lines[kind] and filename:
+                if kind not in files:
+                    files.update({kind: open(filename, 'ab')})
+                files[kind].write(''.join(lines[kind]))
+
+    def worker(self):
+        files = {}
+        flushed = time.time()
+        stop = False
+        while not stop:
             try:
-                print msg
-            except:
-                print msg.encode('ascii', 'ignore') + ' # < non-ASCII chars detected! >'
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except Queue.Empty:
+                batch = []
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                batch = [x for x in batch if x is not None]
+            try:
+                self.write_batch(batch, files)
+                if stop or self.queue.empty() or time.time() - flushed >= self.flush_interval:
+                    for f in files.values():
+                        f.flush()
+                    flushed = time.time()
+            except (IOError, OSError) as e:
+                print '\n[*] Exception while writing log: %s' % str(e)
+        for f in files.values():
+            f.close()
+
+    def close(self):
+        """
+        Write all queued messages and stop the background thread.
+        """
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class DebugTap:
+    """
+    Writes rows to the debug log while they pass through, so that result sets are not read at once.
+    The first DEBUG_MAX_ROWS rows are written as they come, and a random sample of DEBUG_SAMPLE_ROWS of
+    the remaining ones at the end. No more than DEBUG_MAX_BYTES are written per result set.
+    The end of the dump holds the number of rows and, per column, the number of NULLs and of distinct values.
+    """
+    DISTINCT_LIMIT = 1000  # distinct values are counted up to this many per column
+
+    def __init__(self, title):
+        self.title = title
+        self.max_rows = int(getattr(conf, 'DEBUG_MAX_ROWS', 100))
+        self.max_bytes = int(getattr(conf, 'DEBUG_MAX_BYTES', 1048576))
+        self.sample_size = int(getattr(conf, 'DEBUG_SAMPLE_ROWS', 10))
+        self.random = random.Random(0)
+        self.rows = 0
+        self.written = 0
+        self.skipped = 0
+        self.sample = []
+        self.columns = []
+        self.nulls = {}
+        self.distinct = {}
+
+    def tap(self, rows):
+        """
+        :param rows: iterable of tuples or dicts
+        :return: generator of the same rows
+        """
+        logger.debugger((self.title, ''))
+        try:
+            for row in rows:
+                self.add(row)
+                yield row
+        finally:
+            self.finish()
+
+    def write(self, row):
+        # phases run in parallel, so every line names its result set
+        line = '[%s] %s' % (self.title, row)
+        if self.max_bytes and self.written + len(line) > self.max_bytes:
+            self.skipped += 1
+            return
+        self.written += len(line)
+        logger.debug_line(line)
+
+    def add(self, row):
+        self.rows += 1
+        if self.rows <= self.max_rows:
+            self.write(row)
+        elif self.sample_size:
+            # reservoir sampling, every row after the first ones has the same chance to be written
+            seen = self.rows - self.max_rows
+            if seen <= self.sample_size:
+                self.sample.append(str(row))
+            else:
+                i = self.random.randint(0, seen - 1)
+                if i < self.sample_size:
+                    self.sample[i] = str(row)
+
+        if isinstance(row, dict):
+            items = row.items()
+        else:
+            items = enumerate(row)
+        for column, value in items:
+            if column not in self.nulls:
+                self.columns.append(column)
+                self.nulls.update({column: 0})
+                self.distinct.update({column: set()})
+            if value is None:
+                self.nulls[column] += 1
+                continue
+            values = self.distinct[column]
+            if values is not None:
+                values.add(value)
+                if len(values) > self.DISTINCT_LIMIT:
+                    self.distinct[column] = None
+
+    def finish(self):
+        if self.sample:
+            logger.debug_line('[%s] ... %d more rows, random sample of %d:' % (
+                self.title, self.rows - self.max_rows, len(self.sample)))
+            for row in self.sample:
+                self.write(row)
+        if self.skipped:
+            logger.debug_line('[%s] ... %d rows not written, DEBUG_MAX_BYTES reached' % (self.title, self.skipped))
+        logger.debug_line('[%s] %d rows' % (self.title, self.rows))
+        for column in self.columns:
+            values = self.distinct[column]
+            if values is None:
+                distinct = '>%d' % self.DISTINCT_LIMIT
+            else:
+                distinct = str(len(values))
+            logger.debug_line('[%s] column %s: %d NULL, %s distinct' % (
+                self.title, column, self.nulls[column], distinct))
+
+
+class Metrics:
+    """
+    Performance counters of a run: wall time, MySQL queries and Device42 requests per phase,
+    and request count, latency histogram, status codes and bytes per Device42 endpoint.
+    Written to a JSON summary and, optionally, a Prometheus textfile at the end of the run
+    and every `interval` seconds while it runs.
+    """
+    # upper bounds of the request latency histogram, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, json_file, prom_file, interval):
+        self.json_file = json_file
+        self.prom_file = prom_file
+        self.interval = float(interval or 0)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.endpoints = {}
+        self.stopped = threading.Event()
+        self.thread = None
 
     @staticmethod
-    def debugger(msg):
-        if conf.DEBUG_LOG and conf.DEBUG_LOG != '':
-            with codecs.open(conf.DEBUG_LOG, 'a', encoding='utf-8') as f:
-                title, message = msg
-                row = '\n-----------------------------------------------------\n%s\n%s' % (title, message)
-                f.write(row + '\r\n\r\n')  # \r\n for notepad
+    def current_phase():
+        return getattr(context, 'phase', None) or 'main'
+
+    def get_phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = {'started': None, 'finished': None, 'queries': 0, 'query_seconds': 0.0,
+                     'requests': 0, 'request_seconds': 0.0}
+            self.phases.update({name: phase})
+        return phase
+
+    def phase_started(self, name):
+        with self.lock:
+            self.get_phase(name)['started'] = time.time()
+
+    def phase_finished(self, name):
+        with self.lock:
+            self.get_phase(name)['finished'] = time.time()
+
+    def add_query(self, seconds):
+        with self.lock:
+            phase = self.get_phase(self.current_phase())
+            phase['queries'] += 1
+            phase['query_seconds'] += seconds
+
+    def add_request(self, endpoint, status, seconds, sent, received):
+        with self.lock:
+            phase = self.get_phase(self.current_phase())
+            phase['requests'] += 1
+            phase['request_seconds'] += seconds
+
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = {'requests': 0, 'seconds': 0.0, 'buckets': [0] * len(self.BUCKETS),
+                         'status_codes': {}, 'bytes_sent': 0, 'bytes_received': 0}
+                self.endpoints.update({endpoint: stats})
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+            status = str(status)
+            stats['status_codes'].update({status: stats['status_codes'].get(status, 0) + 1})
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+
+    def summary(self):
+        """
+        :return: dict with all counters, histogram buckets are cumulative
+        """
+        now = time.time()
+        with self.lock:
+            phases = {}
+            for name, phase in self.phases.items():
+                wall = 0.0
+                if phase['started']:
+                    wall = (phase['finished'] or now) - phase['started']
+                phases.update({name: {
+                    'wall_seconds': round(wall, 3),
+                    'running': bool(phase['started'] and not phase['finished']),
+                    'mysql_queries': phase['queries'],
+                    'mysql_seconds': round(phase['query_seconds'], 3),
+                    'http_requests': phase['requests'],
+                    'http_seconds': round(phase['request_seconds'], 3)
+                }})
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                buckets = [[str(bound), count] for bound, count in zip(self.BUCKETS, stats['buckets'])]
+                buckets.append(['+Inf', stats['requests']])
+                endpoints.update({endpoint: {
+                    'requests': stats['requests'],
+                    'seconds': round(stats['seconds'], 3),
+                    'latency_buckets': buckets,
+                    'status_codes': dict(stats['status_codes']),
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received']
+                }})
+        return {'started': self.started, 'updated': now, 'elapsed_seconds': round(now - self.started, 3),
+                'phases': phases, 'endpoints': endpoints}
+
+    @staticmethod
+    def prometheus(summary):
+        """
+        :return: summary in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP rt2d42_%s %s' % (name, help_text))
+            lines.append('# TYPE rt2d42_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                lines.append('rt2d42_%s%s{%s} %s' % (name, suffix, label, repr(value)))
+
+        phases = sorted(summary['phases'].items())
+        endpoints = sorted(summary['endpoints'].items())
+        metric('phase_wall_seconds', 'gauge', 'Wall time of the migration phase.',
+               [('', [('phase', k)], v['wall_seconds']) for k, v in phases])
+        metric('mysql_queries_total', 'counter', 'RackTables queries run by the phase.',
+               [('', [('phase', k)], v['mysql_queries']) for k, v in phases])
+        metric('mysql_query_seconds_total', 'counter', 'Time spent in RackTables queries by the phase.',
+               [('', [('phase', k)], v['mysql_seconds']) for k, v in phases])
+        metric('phase_http_requests_total', 'counter', 'Device42 requests sent by the phase.',
+               [('', [('phase', k)], v['http_requests']) for k, v in phases])
+        metric('phase_http_seconds_total', 'counter', 'Time spent in Device42 requests by the phase.',
+               [('', [('phase', k)], v['http_seconds']) for k, v in phases])
+        metric('http_requests_total', 'counter', 'Device42 requests by endpoint and status code.',
+               [('', [('endpoint', k), ('code', code)], count)
+                for k, v in endpoints for code, count in sorted(v['status_codes'].items())])
+        samples = []
+        for k, v in endpoints:
+            samples.extend(('_bucket', [('endpoint', k), ('le', le)], count) for le, count in v['latency_buckets'])
+            samples.append(('_sum', [('endpoint', k)], v['seconds']))
+            samples.append(('_count', [('endpoint', k)], v['requests']))
+        metric('http_request_duration_seconds', 'histogram', 'Device42 request latency.', samples)
+        metric('http_bytes_sent_total', 'counter', 'Request body bytes sent to Device42.',
+               [('', [('endpoint', k)], v['bytes_sent']) for k, v in endpoints])
+        metric('http_bytes_received_total', 'counter', 'Response body bytes received from Device42.',
+               [('', [('endpoint', k)], v['bytes_received']) for k, v in endpoints])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def write_file(filename, text):
+        # write and rename, so that readers never see a half written file
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+    def write(self):
+        if not self.json_file and not self.prom_file:
+            return
+        summary = self.summary()
+        if self.json_file:
+            self.write_file(self.json_file, json.dumps(summary, indent=4, sort_keys=True))
+        if self.prom_file:
+            self.write_file(self.prom_file, self.prometheus(summary))
+
+    def writer(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                print '\n[*] Exception while writing metrics: %s' % str(e)
+
+    def start(self):
+        if self.interval > 0 and (self.json_file or self.prom_file):
+            self.thread = threading.Thread(target=self.writer, name='metrics')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+
+class Journal:
+    """
+    On-disk record of finished phases and uploads, used to resume a migration that crashed.
+    Uploads are stored with the Device42 response, RT objects with the ID Device42 gave them.
+    Only the last upload to each Device42 object is kept (see object_key).
+    """
+
+    def __init__(self, filename, resume):
+        if not resume and os.path.exists(filename):
+            os.remove(filename)
+        self.lock = threading.Lock()
+        self.pending = 0
+        # objects looked up in this run: one 40 character key per uploaded object, about 120 bytes with the set entry,
+        # so 12 MB per 100,000 objects. Kept for the whole run, a later upload of the run may change an object again.
+        self.seen = set()
+        self.commit_every = int(getattr(conf, 'JOURNAL_COMMIT_EVERY', 100))
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS phases (name TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS uploads (key TEXT PRIMARY KEY, payload TEXT, response TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (kind TEXT, rt_id TEXT, d42_id TEXT, '
+                        'PRIMARY KEY (kind, rt_id))')
+        self.db.commit()
+
+    @staticmethod
+    def upload_key(endpoint, data):
+        """
+        :return: (key of the object the upload goes to, key of the uploaded data)
+        """
+        return (hashlib.sha1(endpoint + repr(object_key(endpoint, data))).hexdigest(),
+                hashlib.sha1(repr(sorted(data.items()))).hexdigest())
+
+    def query(self, q, args):
+        with self.lock:
+            return self.db.execute(q, args).fetchone()
+
+    def write(self, q, args):
+        with self.lock:
+            self.db.execute(q, args)
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def get_upload(self, endpoint, data):
+        """
+        Only the first upload of this run to an object is answered, and only if the last upload to it
+        in the interrupted run had the same data. Later uploads to the object may change it again
+        (A, B, A has to end with A), so they are always sent.
+        :return: Device42 response of an earlier upload of the same data, or None
+        """
+        key, data_key = self.upload_key(endpoint, data)
+        with self.lock:
+            if key in self.seen:
+                return None
+            self.seen.add(key)
+        row = self.query('SELECT payload, response FROM uploads WHERE key = ?', (key,))
+        if row and row[0] == data_key:
+            return json.loads(row[1])
+
+    def add_upload(self, endpoint, data, response):
+        key, data_key = self.upload_key(endpoint, data)
+        self.write('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)', (key, data_key, json.dumps(response)))
+
+    def get_id(self, kind, rt_id):
+        """
+        :return: Device42 ID of an uploaded RT object, or None
+        """
+        row = self.query('SELECT d42_id FROM objects WHERE kind = ? AND rt_id = ?', (kind, str(rt_id)))
+        if row:
+            return json.loads(row[0])
+
+    def add_id(self, kind, rt_id, d42_id):
+        self.write('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', (kind, str(rt_id), json.dumps(d42_id)))
+
+    def phase_done(self, name):
+        return self.query('SELECT name FROM phases WHERE name = ?', (name,)) is not None
+
+    def finish_phase(self, name):
+        self.write('INSERT OR REPLACE INTO phases VALUES (?)', (name,))
+        self.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class SyncState:
+    """
+    High-water mark of the last finished run: RackTables server time and highest object ID when the run started.
+    An --incremental run uploads what RackTables changed after it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get(self):
+        """
+        :return: (time, max. object ID) of the last finished run, or None
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as f:
+            state = json.load(f)
+        return state['high_water_mark'], state['max_object_id']
+
+    def set(self, mark, max_object_id):
+        with open(self.filename, 'w') as f:
+            json.dump({'high_water_mark': mark, 'max_object_id': max_object_id, 'version': __version__}, f)
+
+
+# payload fields that identify the object an upload creates or updates, by endpoint. Default is 'name'.
+REPLAY_KEYS = {
+    '/api/1.0/rooms/': ('name', 'building'),
+    '/api/1.0/racks/': ('name', 'room', 'building'),
+    '/api/1.0/subnets/': ('network', 'mask_bits'),
+    '/api/ip/': ('ipaddress',),
+    '/api/1.0/device/rack/': ('device',),
+    '/api/1.0/pdus/rack/': ('pdu_id',),
+    '/api/1.0/switchports/': ('switch', 'port'),
+    '/api/1.0/custom_fields/switchport/': ('id', 'key'),
+}
+
+
+def object_key(endpoint, payload):
+    """
+    :return: the REPLAY_KEYS fields of an upload, or the whole payload if it has none of them
+    """
+    key = tuple(payload.get(x) for x in REPLAY_KEYS.get(endpoint, ('name',)))
+    if not any(key):
+        key = repr(sorted(payload.items()))
+    return key
+
+
+class Exporter:
+    """
+    Writes uploads to an NDJSON file instead of sending them to Device42.
+    IDs assigned by Device42 are not known when exporting, so every upload gets a reference
+    ('@ref:<record id>') that is returned in place of the ID and resolved by replay().
+    """
+    REF = '@ref:'
+
+    def __init__(self, filename, base_url):
+        self.f = open(filename, 'w')
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.seq = 0
+
+    @staticmethod
+    def decode(value):
+        if isinstance(value, str):
+            return value.decode('UTF-8', 'ignore')
+        return value
+
+    def write(self, url, method, data):
+        payload = dict((self.decode(k), self.decode(v)) for k, v in data.items())
+        deps = sorted(set(v for v in payload.values() if isinstance(v, basestring) and v.startswith(self.REF)))
+        with self.lock:
+            self.seq += 1
+            ref = self.REF + str(self.seq)
+            record = {
+                'id': self.seq,
+                'phase': getattr(context, 'phase', None),
+                'endpoint': url[len(self.base_url):],
+                'method': method,
+                'payload': payload,
+                'deps': deps
+            }
+            self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        return {'code': 0, 'msg': ['exported', ref]}
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class D42Index:
+    """
+    Objects that exist in Device42 before the migration, fetched by a pre-flight stage.
+    An upload that would not change the indexed object is answered locally with the ID of the existing object.
+    Payload fields are compared as text, nested objects by their name. Fields that Device42 does not return
+    count as changed.
+    """
+    # upload endpoint -> (GET endpoint, collection, ID field, fields that identify an object,
+    #                     payload field -> field in GET responses, None for fields that are not returned)
+    KINDS = {
+        '/api/1.0/buildings/': ('/api/1.0/buildings/', 'buildings', 'building_id', ('name',), {}),
+        '/api/1.0/rooms/': ('/api/1.0/rooms/', 'rooms', 'room_id', ('name', 'building'), {}),
+        '/api/1.0/racks/': ('/api/1.0/racks/', 'racks', 'rack_id', ('name', 'room', 'building'), {}),
+        '/api/1.0/device/': ('/api/1.0/devices/all/', 'Devices', 'device_id', ('name',),
+                             {'hardware': 'hw_model', 'virtual_host': 'virtual_host_name',
+                              'blade_host': 'blade_host_name'}),
+        '/api/1.0/hardwares/': ('/api/1.0/hardwares/', 'models', 'hardware_id', ('name',), {'type': None}),
+        '/api/1.0/subnets/': ('/api/1.0/subnets/', 'subnets', 'subnet_id', ('network', 'mask_bits'), {}),
+        '/api/ip/': ('/api/1.0/ips/', 'ips', 'id', ('ipaddress',), {'ipaddress': 'ip', 'tag': 'label'}),
+        '/api/1.0/pdus/': ('/api/1.0/pdus/', 'pdus', 'pdu_id', ('name',), {}),
+        '/api/1.0/pdu_models/': ('/api/1.0/pdu_models/', 'pdu_models', 'pdu_model_id', ('name',), {}),
+        '/api/1.0/patch_panel_models/': ('/api/1.0/patch_panel_models/', 'patch_panel_models',
+                                         'patch_panel_model_id', ('name',), {}),
+        '/api/1.0/patch_panel_module_models/': ('/api/1.0/patch_panel_module_models/', 'patch_panel_module_models',
+                                                'id', ('name',), {}),
+        '/api/1.0/switchports/': ('/api/1.0/switchports/', 'switchports', 'switchport_id', ('switch', 'port'), {}),
+    }
+    # uploads that change a part of an indexed object, Device42 returns them with the object:
+    # upload endpoint -> (endpoint of the indexed objects, ID field, fields that identify a part,
+    #                     payload field -> field of the indexed object)
+    PARTS = {
+        '/api/1.0/device/rack/': ('/api/1.0/device/', 'device_id', ('device',), {'device': 'name'}),
+        '/api/1.0/pdus/rack/': ('/api/1.0/pdus/', 'pdu_id', ('pdu_id',), {}),
+        # one part per entry of the switchport's custom_fields
+        '/api/1.0/custom_fields/switchport/': ('/api/1.0/switchports/', 'id', ('id', 'key'), {'id': 'switchport_id'}),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # endpoint -> (name in messages, ID field, fields that identify an object, fields that are not returned)
+        self.kinds = dict((endpoint, (x[1], x[2], x[3], [k for k, v in x[4].items() if v is None]))
+                          for endpoint, x in self.KINDS.items())
+        self.kinds.update((endpoint, (endpoint.strip('/').split('/', 2)[-1], x[1], x[2], []))
+                          for endpoint, x in self.PARTS.items())
+        self.objects = dict((endpoint, {}) for endpoint in self.kinds)
+        self.skipped = 0
+
+    @staticmethod
+    def normalize(value):
+        if isinstance(value, dict):
+            value = value.get('name')
+        if value is None:
+            return u''
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, str):
+            value = value.decode('UTF-8', 'ignore')
+        return unicode(value).strip()
+
+    def key(self, endpoint, data):
+        return tuple(self.normalize(data.get(x)) for x in self.kinds[endpoint][2])
+
+    def parts(self, endpoint, record):
+        """
+        :return: the parts of an indexed object that uploads to `endpoint` change, under the payload field names
+        """
+        source, id_field, key_fields, fields = self.PARTS[endpoint]
+        obj = dict(record)
+        for field, get_field in fields.items():
+            obj.update({field: record.get(get_field)})
+        if endpoint == '/api/1.0/custom_fields/switchport/':
+            return [dict(obj, key=x.get('key'), value=x.get('value')) for x in record.get('custom_fields') or []]
+        return [obj]
+
+    def load(self, endpoint):
+        get_endpoint, collection, id_field, key_fields, fields = self.KINDS[endpoint]
+        objects = {}
+        try:
+            for record in rest.pages(get_endpoint, collection):
+                # index records under the payload field names
+                obj = dict(record)
+                for field, get_field in fields.items():
+                    if get_field:
+                        obj.update({field: record.get(get_field)})
+                objects.update({self.key(endpoint, obj): obj})
+        except (ValueError, AttributeError) as e:
+            msg = '\n[!] Cannot index Device42 %s: %s' % (collection, str(e))
+            logger.writer(msg, Logger.WARNING)
+            return
+        parts = {}
+        for part, (source, id_field, key_fields, fields) in self.PARTS.items():
+            if source == endpoint:
+                parts[part] = dict((self.key(part, x), x) for obj in objects.values() for x in self.parts(part, obj))
+        with self.lock:
+            self.objects[endpoint] = objects
+            self.objects.update(parts)
+        msg = '[!] Indexed %d Device42 %s' % (len(objects), collection)
+        logger.writer(msg)
+
+    def load_all(self):
+        uploads.map(self.load, sorted(self.KINDS))
+
+    def records(self, endpoint):
+        with self.lock:
+            return self.objects[endpoint].values()
+
+    def lookup(self, endpoint, data):
+        """
+        :return: response for an upload that would not change the indexed object, or None
+        """
+        if endpoint not in self.kinds:
+            return None
+        collection, id_field, key_fields, not_returned = self.kinds[endpoint]
+        with self.lock:
+            obj = self.objects[endpoint].get(self.key(endpoint, data))
+            if obj is None or obj.get(id_field) is None:
+                return None
+            for field, value in data.items():
+                # fields set to None are not sent
+                if value is None or field in not_returned:
+                    continue
+                if field not in obj or self.normalize(obj[field]) != self.normalize(value):
+                    return None
+            self.skipped += 1
+            return {'code': 0, 'msg': ['%s unchanged.' % collection, obj[id_field], data.get(key_fields[0]),
+                                       False, False]}
+
+    def update(self, endpoint, data, response):
+        """
+        Record an upload, so that the same upload is not sent twice.
+        """
+        if endpoint not in self.kinds:
+            return
+        obj_id = REST.response_id(response)
+        id_field = self.kinds[endpoint][1]
+        with self.lock:
+            obj = self.objects[endpoint].setdefault(self.key(endpoint, data), {})
+            obj.update(data)
+            # parts are identified by the ID of their object, not by the ID in the response
+            if obj_id is not None and id_field not in data:
+                obj.update({id_field: obj_id})
+
+
+class ConcurrencyLimiter:
+    """
+    AIMD (additive increase, multiplicative decrease) limit for the number of Device42 requests in flight.
+    The limit grows by about one per round of requests that finish without errors and within target_latency.
+    It is cut by DECREASE when a request is throttled (429), fails with 5xx, times out or is slower than
+    target_latency. Only requests started after the last cut can cut the limit again, so a burst of failures
+    counts once.
+    """
+    DECREASE = 0.5
+
+    def __init__(self, minimum, maximum, target_latency):
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.target_latency = float(target_latency or 0)
+        self.limit = float(self.minimum)
+        self.lowest = self.highest = self.minimum
+        self.inflight = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, started, seconds, overloaded):
+        with self.cond:
+            self.inflight -= 1
+            if overloaded or (self.target_latency and seconds > self.target_latency):
+                if started >= self.last_decrease:
+                    self.limit = max(self.limit * self.DECREASE, self.minimum)
+                    self.last_decrease = time.time()
+            elif self.limit < self.maximum:
+                self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+            self.lowest = min(self.lowest, int(self.limit))
+            self.highest = max(self.highest, int(self.limit))
+            self.cond.notify_all()
 
 
 class REST:
+    RETRY_STATUS = (429, 502, 503, 504)
+    # uploads that create or update the object their identifying fields name, so sending them again does no harm.
+    # Other uploads (pdus/rack, patch panel module models) can create duplicates, they are only retried
+    # if they did not reach Device42.
+    IDEMPOTENT = ('/api/1.0/subnets/', '/api/ip/', '/api/1.0/device/', '/api/1.0/buildings/', '/api/1.0/rooms/',
+                  '/api/1.0/racks/', '/api/1.0/pdus/', '/api/1.0/pdu_models/', '/api/1.0/hardwares/',
+                  '/api/1.0/device/rack/', '/api/1.0/switchports/', '/api/1.0/custom_fields/switchport/',
+                  '/api/1.0/patch_panel_models/')
+
     def __init__(self):
         self.password = conf.D42_PWD
         self.username = conf.D42_USER
         self.base_url = conf.D42_URL
-
-    def uploader(self, data, url):
-        payload = data
-        headers = {
+        self.headers = {
             'Authorization': 'Basic ' + base64.b64encode(self.username + ':' + self.password),
             'Content-Type': 'application/x-www-form-urlencoded'
         }
+        if not getattr(conf, 'D42_KEEPALIVE', True):
+            self.headers.update({'Connection': 'close'})
+
+        # one pool of keep-alive connections, shared by all threads
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                     pool_maxsize=int(getattr(conf, 'D42_POOL_SIZE', 10)),
+                                                     pool_block=getattr(conf, 'D42_POOL_BLOCK', True))
+        self.local = threading.local()
+        self.journal = None
+        self.exporter = None
+        self.index = None
+
+        self.timeout = float(getattr(conf, 'D42_TIMEOUT', 60))
+        self.retries = int(getattr(conf, 'D42_RETRIES', 3))
+        self.backoff = float(getattr(conf, 'D42_BACKOFF', 0.5))
+        self.backoff_max = float(getattr(conf, 'D42_BACKOFF_MAX', 30))
+        self.limiter = ConcurrencyLimiter(getattr(conf, 'D42_MIN_INFLIGHT', 1),
+                                          getattr(conf, 'D42_MAX_INFLIGHT', getattr(conf, 'D42_POOL_SIZE', 10)),
+                                          getattr(conf, 'D42_TARGET_LATENCY', 2))
+        self.lock = threading.Lock()
+        self.retried = 0
+        self.page_size = int(getattr(conf, 'D42_PAGE_SIZE', 1000))
+        self.prefetch = getattr(conf, 'D42_PREFETCH', True)
+        self.prefetches = Queue.Queue()
+        self.prefetcher = None
+
+        # endpoint -> UploadBatch, for endpoints that accept many records in one request
+        self.batches = {}
+        # endpoints whose uploads are retried after any failure, see IDEMPOTENT
+        self.idempotent = set(self.IDEMPOTENT)
+        for endpoint, bulk_endpoint in getattr(conf, 'BULK_ENDPOINTS', {}).items():
+            self.batches.update({endpoint: UploadBatch(self, self.base_url + endpoint, self.base_url + bulk_endpoint,
+                                                       getattr(conf, 'BATCH_SIZE', 100),
+                                                       getattr(conf, 'BATCH_INTERVAL', 0.5))})
+            if endpoint in self.IDEMPOTENT:
+                self.idempotent.add(bulk_endpoint)
+
+    def get_session(self):
+        """
+        requests.Session is not thread safe, so every thread gets its own session.
+        All sessions are mounted on the same adapter and thus share the connection pool.
+        :return: session for the current thread
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.verify = False
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self.local.session = session
+        return session
+
+    def connection_stats(self):
+        """
+        Count pooled connections to Device42.
+        :return:
+            reused  - number of requests that were sent over an already open connection
+            opened  - number of newly opened connections
+        """
+        sent = 0
+        opened = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            sent += pool.num_requests
+            opened += pool.num_connections
+        return sent - opened, opened
+
+    def request(self, method, url, data=None, headers=None):
+        """
+        Send a request to Device42 and record it in the metrics.
+        Request errors (connection errors, timeouts, broken responses) and RETRY_STATUS responses are retried
+        up to D42_RETRIES times, after a random delay that doubles with every attempt
+        (D42_BACKOFF, at most D42_BACKOFF_MAX seconds). Uploads to endpoints that are not idempotent are only
+        retried if the connection could not be opened, a timeout or an error response does not prove that
+        Device42 did not store them.
+        :return: response
+        """
+        endpoint = url[len(self.base_url):].split('?')[0]
+        idempotent = method == 'GET' or endpoint in self.idempotent
+        attempt = 0
+        while 1:
+            self.limiter.acquire()
+            start = time.time()
+            r = None
+            try:
+                r = self.get_session().request(method, url, data=data, headers=headers, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                error = e
+            finally:
+                # also on errors that are not retried (KeyboardInterrupt), a lost slot blocks the other threads
+                seconds = time.time() - start
+                self.limiter.release(start, seconds, r is None or r.status_code == 429 or r.status_code >= 500)
+
+            if r is not None:
+                metrics.add_request(endpoint, r.status_code, seconds, len(r.request.body or ''), len(r.content))
+                if r.status_code not in self.RETRY_STATUS:
+                    return r
+                reason = 'status code %d' % r.status_code
+            else:
+                metrics.add_request(endpoint, 'error', seconds, 0, 0)
+                reason = str(error)
+            if attempt >= self.retries or not (idempotent or r is None and self.not_sent(error)):
+                if r is None:
+                    raise error
+                return r
+
+            attempt += 1
+            with self.lock:
+                self.retried += 1
+            delay = random.uniform(0, min(self.backoff * 2 ** attempt, self.backoff_max))
+            if r is not None and r.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, float(r.headers['Retry-After']))
+            msg = '[!] %s %s failed (%s), retry %d of %d in %.1fs' % (method, endpoint, reason, attempt,
+                                                                     self.retries, delay)
+            logger.writer(msg, Logger.WARNING)
+            time.sleep(delay)
+
+    @staticmethod
+    def not_sent(error):
+        """
+        :return: True if a request failed before it reached Device42, because no connection could be opened
+        """
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, requests.packages.urllib3.exceptions.ConnectTimeoutError)
+
+    @staticmethod
+    def response_id(response):
+        """
+        :return: ID of the object an upload created or updated, or None if the upload failed
+        """
+        try:
+            if isinstance(response['msg'], list):
+                return response['msg'][1]
+        except (TypeError, KeyError, IndexError):
+            pass
+        return None
 
+    def uploader(self, data, url):
+        payload = data
         if 'custom_fields' in url:
-            r = requests.put(url, data=payload, headers=headers, verify=False)
+            method = 'PUT'
         else:
-            r = requests.post(url, data=payload, headers=headers, verify=False)
-        msg = unicode(payload)
-        logger.writer(msg)
+            method = 'POST'
+        if self.exporter:
+            return self.exporter.write(url, method, payload)
+        endpoint = url[len(self.base_url):]
+        if self.index:
+            response = self.index.lookup(endpoint, payload)
+            if response is not None:
+                logger.body(u'Unchanged in Device42: %s' % unicode(payload))
+                return response
+        if self.journal:
+            response = self.journal.get_upload(endpoint, payload)
+            if response is not None:
+                logger.body(u'Already uploaded: %s' % unicode(payload))
+                return response
+
+        batch = self.batches.get(endpoint)
+        if batch and getattr(context, 'batch', False):
+            # sent later, together with other records (see UploadPool.consume)
+            return batch.add(method, payload)
+        return self.send(method, url, payload)
+
+    def send(self, method, url, payload):
+        """
+        Upload one record.
+        :return: decoded response
+        """
+        r = self.request(method, url, payload)
+        logger.body(payload)
         msg = 'Status code: %s' % str(r.status_code)
-        logger.writer(msg)
-        msg = str(r.text)
-        logger.writer(msg)
+        logger.writer(msg, Logger.WARNING if r.status_code >= 400 else Logger.INFO)
+        logger.body(r.text)
 
         try:
-            return r.json()
+            response = r.json()
         except Exception as e:
 
             print '\n[*] Exception: %s' % str(e)
-            pass
+            return
 
-    def fetcher(self, url):
-        headers = {
-            'Authorization': 'Basic ' + base64.b64encode(self.username + ':' + self.password),
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
+        if r.status_code < 400:
+            self.uploaded(url, payload, response)
+        return response
 
-        r = requests.get(url, headers=headers, verify=False)
+    def send_batch(self, method, url, bulk_url, payloads):
+        """
+        Upload many records in one request to a bulk endpoint (BULK_ENDPOINTS).
+        The records are sent as a JSON list, the response has to be a list with one response per record.
+        Fields that are None are left out, like form posts do.
+        :return: list of decoded responses, or None if the batch failed
+        """
+        records = [dict((k, v) for k, v in payload.items() if v is not None) for payload in payloads]
+        r = self.request(method, bulk_url, json.dumps(records), {'Content-Type': 'application/json'})
+        msg = 'Status code: %s (%d records)' % (str(r.status_code), len(payloads))
+        logger.writer(msg, Logger.WARNING if r.status_code >= 400 else Logger.INFO)
+        logger.body(r.text)
+        if r.status_code >= 400:
+            return None
+        try:
+            responses = r.json()
+        except ValueError:
+            return None
+        if not isinstance(responses, list) or len(responses) != len(payloads):
+            return None
+
+        for payload, response in zip(payloads, responses):
+            logger.body(payload)
+            self.uploaded(url, payload, response)
+        return responses
+
+    def uploaded(self, url, payload, response):
+        """
+        Record a successful upload in the journal and the index.
+        """
+        if self.journal:
+            self.journal.add_upload(url[len(self.base_url):], payload, response)
+        if self.index:
+            self.index.update(url[len(self.base_url):], payload, response)
+
+    def fetcher(self, url):
+        if self.exporter:
+            # exports are made without contacting Device42, so it looks empty
+            return '{}'
+        r = self.request('GET', url)
         msg = 'Status code: %s' % str(r.status_code)
         logger.writer(msg)
-        msg = str(r.text)
-        logger.writer(msg)
+        logger.body(r.text)
         return r.text
 
+    def fetch_page(self, url, limit, offset, background=False):
+        """
+        Fetch one page of a collection.
+        :param background: fetch it in the prefetch thread, the caller goes on meanwhile
+        :return: Future with the decoded page
+        """
+        future = Future()
+        phase = getattr(context, 'phase', None)
+
+        def fetch():
+            context.phase = phase
+            try:
+                future.set_result(json.loads(self.fetcher('%s?limit=%d&offset=%d' % (url, limit, offset))))
+            except:
+                future.set_error(sys.exc_info())
+
+        if background:
+            with self.lock:
+                if self.prefetcher is None:
+                    self.prefetcher = threading.Thread(target=self.prefetch_worker, name='prefetch')
+                    self.prefetcher.daemon = True
+                    self.prefetcher.start()
+            self.prefetches.put(fetch)
+        else:
+            fetch()
+        return future
+
+    def prefetch_worker(self):
+        """
+        One thread prefetches the pages of all collections, one at a time. It only waits for Device42,
+        so it cannot block the upload pool, and its requests count towards the in-flight limit like all others.
+        """
+        while 1:
+            self.prefetches.get()()
+
+    def pages(self, endpoint, collection):
+        """
+        Fetch all objects of a collection, D42_PAGE_SIZE objects at a time.
+        With D42_PREFETCH the next page is fetched while the objects of the current page are processed.
+        Paging stops at a short page, and also when the server ignores limit and offset (a page with more
+        than limit objects or the same objects as the previous page), even if it sends no total_count.
+        :return: generator of objects
+        """
+        url = self.base_url + endpoint
+        limit = self.page_size
+        offset = 0
+        previous = None
+        page = self.fetch_page(url, limit, offset)
+        while page is not None:
+            data = page.result()
+            objects = data.get(collection, [])
+            if objects == previous:
+                break
+            previous = objects
+            offset += limit
+            more = len(objects) == limit and offset < data.get('total_count', offset + 1)
+            page = None
+            if more and self.prefetch:
+                page = self.fetch_page(url, limit, offset, True)
+            for obj in objects:
+                yield obj
+            if more and not self.prefetch:
+                page = self.fetch_page(url, limit, offset)
+
     def post_subnet(self, data):
         url = self.base_url + '/api/1.0/subnets/'
         msg = '\r\nPosting data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_ip(self, data):
         url = self.base_url + '/api/ip/'
         msg = '\r\nPosting IP data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_device(self, data):
         url = self.base_url + '/api/1.0/device/'
         msg = '\r\nPosting device data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_location(self, data):
         url = self.base_url + '/api/1.0/buildings/'
         msg = '\r\nPosting location data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_room(self, data):
         url = self.base_url + '/api/1.0/rooms/'
         msg = '\r\nPosting room data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_rack(self, data):
         url = self.base_url + '/api/1.0/racks/'
@@ -179,25 +1201,25 @@ class REST:
         url = self.base_url + '/api/1.0/pdus/rack/'
         msg = '\r\nPosting PDU to rack %s ' % rack
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_hardware(self, data):
         url = self.base_url + '/api/1.0/hardwares/'
         msg = '\r\nAdding hardware data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_device2rack(self, data):
         url = self.base_url + '/api/1.0/device/rack/'
         msg = '\r\nAdding device to rack at %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_building(self, data):
         url = self.base_url + '/api/1.0/buildings/'
         msg = '\r\nUploading building data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_switchport(self, data):
         url = self.base_url + '/api/1.0/switchports/'
@@ -217,56 +1239,569 @@ class REST:
         url = self.base_url + '/api/1.0/patch_panel_models/'
         msg = '\r\nUploading patch panels data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def post_patch_panel_module_models(self, data):
         url = self.base_url + '/api/1.0/patch_panel_module_models/'
         msg = '\r\nUploading patch panels modules data to %s ' % url
         logger.writer(msg)
-        self.uploader(data, url)
+        return self.uploader(data, url)
 
     def get_pdu_models(self):
         url = self.base_url + '/api/1.0/pdu_models/'
         msg = '\r\nFetching PDU models from %s ' % url
         logger.writer(msg)
-        self.fetcher(url)
+        return self.pages('/api/1.0/pdu_models/', 'pdu_models')
 
     def get_racks(self):
         url = self.base_url + '/api/1.0/racks/'
         msg = '\r\nFetching racks from %s ' % url
         logger.writer(msg)
-        data = self.fetcher(url)
-        return json.loads(data)
+        return self.pages('/api/1.0/racks/', 'racks')
 
     def get_devices(self):
         url = self.base_url + '/api/1.0/devices/'
         msg = '\r\nFetching devices from %s ' % url
         logger.writer(msg)
-        data = self.fetcher(url)
-        return data
+        return self.pages('/api/1.0/devices/', 'Devices')
 
     def get_buildings(self):
         url = self.base_url + '/api/1.0/buildings/'
         msg = '\r\nFetching buildings from %s ' % url
         logger.writer(msg)
-        data = self.fetcher(url)
-        return data
+        return self.pages('/api/1.0/buildings/', 'buildings')
 
     def get_rooms(self):
         url = self.base_url + '/api/1.0/rooms/'
         msg = '\r\nFetching rooms from %s ' % url
         logger.writer(msg)
-        data = self.fetcher(url)
-        return data
+        return self.pages('/api/1.0/rooms/', 'rooms')
+
+
+class Future:
+    """
+    Result of an upload submitted to UploadPool.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.done.set()
+
+    def set_error(self, exc_info):
+        self.error = exc_info
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        if isinstance(self.value, Future):
+            # the upload was added to a batch
+            return self.value.result()
+        return self.value
+
+    def ready(self):
+        """
+        :return: True if result() does not have to wait
+        """
+        if not self.done.is_set():
+            return False
+        if isinstance(self.value, Future):
+            return self.value.ready()
+        return True
+
+
+class BatchFuture(Future):
+    """
+    Result of an upload added to an UploadBatch. Waiting for it sends the batch at once.
+    """
+
+    def __init__(self, batch):
+        Future.__init__(self)
+        self.batch = batch
+        self.sent = False
+
+    def result(self):
+        if not self.sent:
+            self.batch.flush(self)
+        return Future.result(self)
+
+
+class UploadBatch:
+    """
+    Collects uploads to an endpoint that accepts many records in one request (BULK_ENDPOINTS).
+    A batch is sent when it holds `size` records, when its oldest record waited `interval` seconds
+    or when the result of one of its records is needed. Batches are sent by the thread that fills them,
+    or by a timer thread when they are not filled in time, so several batches can be in flight at a time.
+    If a batch fails, its records are sent one by one, so that every record gets its own response.
+    """
+    MAX_FAILURES = 3  # bulk uploads are given up if that many batches fail before one succeeds
+
+    def __init__(self, rest, url, bulk_url, size, interval):
+        self.rest = rest
+        self.url = url
+        self.bulk_url = bulk_url
+        self.size = max(int(size), 1)
+        self.interval = float(interval)
+        self.lock = threading.Lock()
+        self.records = []
+        self.started = None
+        self.timer = None
+        self.sent = 0
+        self.failed = 0
+
+    def add(self, method, payload):
+        """
+        :return: BatchFuture with the response
+        """
+        future = BatchFuture(self)
+        with self.lock:
+            if not self.records:
+                self.started = time.time()
+                if self.interval > 0:
+                    self.timer = threading.Timer(self.interval, self.expire, [getattr(context, 'phase', None)])
+                    self.timer.daemon = True
+                    self.timer.start()
+            self.records.append((method, payload, future))
+            if len(self.records) >= self.size or time.time() - self.started >= self.interval:
+                records = self.take()
+            else:
+                records = None
+        if records:
+            self.send(records)
+        return future
+
+    def take(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        records = self.records
+        self.records = []
+        for method, payload, future in records:
+            future.sent = True
+        return records
+
+    def flush(self, future=None):
+        """
+        Send the collected records now. With `future`, only if its record was not sent yet.
+        """
+        with self.lock:
+            if future is not None and future.sent:
+                return
+            records = self.take()
+        if records:
+            self.send(records)
+
+    def expire(self, phase):
+        """
+        Timer: send the batch whose oldest record waited `interval` seconds, unless it was sent meanwhile.
+        """
+        context.phase = phase
+        with self.lock:
+            if self.timer is not threading.current_thread():
+                return
+            records = self.take()
+        if records:
+            self.send(records)
+
+    def send(self, records):
+        responses = None
+        methods = set(x[0] for x in records)
+        if len(methods) == 1 and self.failed < self.MAX_FAILURES:
+            try:
+                responses = self.rest.send_batch(methods.pop(), self.url, self.bulk_url, [x[1] for x in records])
+            except Exception as e:
+                msg = '\n[!] Bulk upload of %d records to %s failed: %s' % (len(records), self.bulk_url, str(e))
+                logger.writer(msg, Logger.WARNING)
+            with self.lock:
+                if responses is not None:
+                    self.sent += 1
+                elif not self.sent:
+                    self.failed += 1
+                    if self.failed == self.MAX_FAILURES:
+                        msg = '\n[!] Bulk uploads to %s failed, records are sent one by one' % self.bulk_url
+                        logger.writer(msg, Logger.WARNING)
+        if responses is not None:
+            for (method, payload, future), response in zip(records, responses):
+                future.set_result(response)
+            return
+        # one by one, so that a failure belongs to its record
+        for method, payload, future in records:
+            try:
+                future.set_result(self.rest.send(method, self.url, payload))
+            except:
+                future.set_error(sys.exc_info())
+
+
+class UploadPool:
+    """
+    Bounded pool of worker threads for uploads that do not depend on each other.
+    With a single worker, uploads run in the calling thread.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(int(workers), 1)
+        # bounded so that producers cannot run far ahead of the uploads
+        self.tasks = Queue.Queue(maxsize=self.workers * 4)
+        # uploads pending in consume(), enough to fill batches of bulk endpoints while others are sent
+        self.window = max(self.workers * 8, 2 * int(getattr(conf, 'BATCH_SIZE', 100)))
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self.worker, name='uploader-%d' % len(self.threads))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def worker(self):
+        while 1:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, phase, func, args = task
+            context.phase = phase
+            # uploads of map() and consume() may be batched, their results are waited for
+            context.batch = True
+            try:
+                future.set_result(func(*args))
+            except:
+                future.set_error(sys.exc_info())
+
+    def submit(self, func, *args):
+        future = Future()
+        if self.workers == 1:
+            batch = getattr(context, 'batch', False)
+            context.batch = True
+            try:
+                future.set_result(func(*args))
+            except:
+                future.set_error(sys.exc_info())
+            finally:
+                context.batch = batch
+        else:
+            if not self.threads:
+                self.start()
+            self.tasks.put((future, getattr(context, 'phase', None), func, args))
+        return future
+
+    def close(self):
+        with self.lock:
+            for t in self.threads:
+                self.tasks.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads = []
+
+    def map(self, func, items):
+        """
+        Upload all items and wait for them.
+        :param func: upload function, called with one item
+        :param items: iterable of payloads
+        :return: list of responses, in the order of items
+        """
+        futures = [self.submit(func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def consume(self, func, items):
+        """
+        Upload items as they are produced and wait for them, without keeping their responses.
+        Only a bounded number of uploads is pending at a time, so items can be a generator
+        over streamed rows.
+        :param func: upload function, called with one item
+        :param items: iterable of payloads
+        :return: number of uploaded items
+        """
+        pending = collections.deque()
+        count = 0
+        try:
+            for item in items:
+                pending.append(self.submit(func, item))
+                count += 1
+                while pending and (pending[0].ready() or len(pending) > self.window):
+                    pending.popleft().result()
+        finally:
+            # wait for the uploads already submitted, even if the producer failed
+            errors = []
+            while pending:
+                try:
+                    pending.popleft().result()
+                except Exception:
+                    errors.append(sys.exc_info())
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return count
+
+
+class Phase:
+    """
+    One step of the migration.
+    :param name: phase name, used in logs
+    :param func: function that runs the phase
+    :param requires: names of the data the phase needs (for example 'rack_id_map')
+    :param provides: names of the data the phase produces
+    """
+
+    def __init__(self, name, func, requires=(), provides=()):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.provides = list(provides)
+        self.deps = []
+        self.started = None
+        self.finished = None
+
+    def duration(self):
+        return self.finished - self.started
+
+
+class PhaseScheduler:
+    """
+    Runs each phase as soon as all phases providing its requirements are finished.
+    Independent phases run in parallel, up to `workers` at a time.
+    """
+
+    def __init__(self, phases, workers, journal=None):
+        self.phases = phases
+        self.workers = max(int(workers), 1)
+        self.journal = journal
+        self.resolve()
+
+    def resolve(self):
+        providers = {}
+        for phase in self.phases:
+            for output in phase.provides:
+                providers.update({output: phase})
+        for phase in self.phases:
+            try:
+                phase.deps = [providers[x] for x in phase.requires]
+            except KeyError as e:
+                raise ValueError('Phase "%s" requires "%s", which no phase provides' % (phase.name, e.args[0]))
+
+        # reject cycles
+        done = set()
+        pending = list(self.phases)
+        while pending:
+            ready = [p for p in pending if all(d in done for d in p.deps)]
+            if not ready:
+                raise ValueError('Circular phase dependencies: %s' % ', '.join(p.name for p in pending))
+            for p in ready:
+                done.add(p)
+                pending.remove(p)
+
+    def run_phase(self, phase, finished):
+        context.phase = phase.name
+        phase.started = time.time()
+        metrics.phase_started(phase.name)
+        try:
+            phase.func()
+            exc_info = None
+        except:
+            exc_info = sys.exc_info()
+        phase.finished = time.time()
+        metrics.phase_finished(phase.name)
+        if self.journal and not exc_info:
+            self.journal.finish_phase(phase.name)
+        finished.put((phase, exc_info))
+
+    def get_finished(self):
+        """
+        Phases finished by an earlier run that can be skipped.
+        A finished phase runs again if a phase that has to run needs its data.
+        Its uploads are then answered from the journal.
+        :return: set of phases
+        """
+        if not self.journal:
+            return set()
+        finished = set(p for p in self.phases if self.journal.phase_done(p.name))
+        needed = True
+        while needed:
+            needed = False
+            for phase in self.phases:
+                if phase in finished:
+                    continue
+                for dep in phase.deps:
+                    if dep in finished:
+                        finished.remove(dep)
+                        needed = True
+        return finished
+
+    def run(self):
+        finished = Queue.Queue()
+        done = self.get_finished()
+        pending = [p for p in self.phases if p not in done]
+        running = 0
+        error = None
+        for phase in done:
+            phase.started = phase.finished = time.time()
+            msg = '\n[!] Skipping phase "%s", it was finished by an earlier run' % phase.name
+            logger.writer(msg)
+
+        while pending or running:
+            if error is None:
+                # phases are started in declaration order when they are ready
+                for phase in list(pending):
+                    if running >= self.workers:
+                        break
+                    if all(d in done for d in phase.deps):
+                        pending.remove(phase)
+                        msg = '\n[!] Starting phase "%s"' % phase.name
+                        logger.writer(msg)
+                        t = threading.Thread(target=self.run_phase, args=(phase, finished), name=phase.name)
+                        t.daemon = True
+                        t.start()
+                        running += 1
+            elif not running:
+                break
+
+            phase, exc_info = finished.get()
+            running -= 1
+            if exc_info:
+                if error is None:
+                    error = exc_info
+            else:
+                done.add(phase)
+                msg = '\n[!] Phase "%s" finished in %.1fs' % (phase.name, phase.duration())
+                logger.writer(msg)
+
+        if error:
+            raise error[0], error[1], error[2]
+
+    def critical_path(self):
+        """
+        Longest chain of dependent phases.
+        :return: list of phases
+        """
+        longest = {}
+
+        def chain(phase):
+            if phase not in longest:
+                before = max([chain(d) for d in phase.deps] or [(0, [])], key=lambda x: x[0])
+                longest.update({phase: (before[0] + phase.duration(), before[1] + [phase])})
+            return longest[phase]
+
+        return max([chain(p) for p in self.phases], key=lambda x: x[0])[1]
+
+
+class HardwareRegistry:
+    """
+    Hardware models known to the migration, keyed by model name.
+    Every model is posted to Device42 only once, with the smallest size seen for it. Of several devices with
+    that size, the depth of the last one is used, like the last of the uploads per device did before.
+    A model whose upload failed is posted again with the next device that uses it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sizes = {}
+        self.posted = set()
+        self.avoided = 0
+
+    def set_size(self, name, height, depth):
+        with self.lock:
+            known = self.sizes.get(name)
+            if known is None or known[0] is None or (height is not None and float(height) <= float(known[0])):
+                self.sizes.update({name: (height, depth)})
+
+    def post(self, hwddata):
+        name = hwddata['name']
+        with self.lock:
+            if name in self.posted:
+                self.avoided += 1
+                return
+            self.posted.add(name)
+            height, depth = self.sizes.get(name, (None, None))
+        if height is not None:
+            hwddata.update({'size': height})
+            hwddata.update({'depth': depth})
+        response = rest.post_hardware(hwddata)
+        if REST.response_id(response) is None:
+            with self.lock:
+                self.posted.discard(name)
+        return response
+
+
+class TimedCursorMixin(object):
+    """
+    Records the time of every query in the metrics of the running phase.
+    """
+
+    def execute(self, query, args=None):
+        start = time.time()
+        try:
+            return super(TimedCursorMixin, self).execute(query, args)
+        finally:
+            metrics.add_query(time.time() - start)
+
+
+class TimedCursor(TimedCursorMixin, sql.cursors.Cursor):
+    """
+    Cursor that records the time of every query.
+    """
+
+
+class TimedSSCursor(TimedCursorMixin, sql.cursors.SSCursor):
+    """
+    Unbuffered TimedCursor: rows are streamed from the server while they are read (DB_STREAMING).
+    Only the time until the first row is recorded.
+    """
 
 
-class DB:
+class ChangeSet:
+    """
+    What changed in RackTables since a high-water mark, read from RT's change history:
+    ObjectHistory (objects added or edited), ObjectLog (log entries), MountOperation (rack space),
+    PortLog (ports and links), IPv4Log and IPv6Log (IP addresses and allocations).
+    Objects with an ID above the highest ID of the last run are new, even without history.
+    """
+    QUERIES = (
+        ('objects', 'SELECT DISTINCT id FROM ObjectHistory WHERE ctime >= %s'),
+        ('objects', 'SELECT DISTINCT object_id FROM ObjectLog WHERE date >= %s'),
+        ('objects', 'SELECT DISTINCT object_id FROM MountOperation WHERE ctime >= %s'),
+        ('ports', 'SELECT DISTINCT port_id FROM PortLog WHERE date >= %s'),
+        ('ips', 'SELECT DISTINCT ip FROM IPv4Log WHERE date >= %s'),
+        ('ips6', 'SELECT DISTINCT ip FROM IPv6Log WHERE date >= %s'),
+    )
+
+    def __init__(self, since, max_object_id):
+        self.since = since
+        self.max_object_id = max_object_id
+        self.objects = set()
+        self.ports = set()
+        self.ips = set()
+        self.ips6 = set()
+
+    def has_object(self, object_id):
+        return object_id in self.objects or object_id > self.max_object_id
+
+
+# rows converted at a time by DB.addresses
+ADDRESS_CHUNK = 1000
+# runs of zero groups of an IPv6 address, longest first, see DB.format_ipv6s
+IPV6_ZEROS = tuple(':' + '0:' * n for n in range(8, 1, -1))
+IPV6_ZEROS_V4 = (0, 0, 0, 0, 0)  # first groups of IPv4-mapped and IPv4-compatible addresses
+
+
+class DB(object):
     """
     Fetching data from Racktables and converting them to Device42 API format.
     """
 
     def __init__(self):
-        self.con = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.rackspace = None
+        self.hardware_models = HardwareRegistry()
+        self.ports_by_device = {}
+        self.ports_by_id = {}
+        self.links = {}
         self.tables = []
         self.rack_map = []
         self.vm_hosts = {}
@@ -274,80 +1809,259 @@ class DB:
         self.rack_id_map = {}
         self.container_map = {}
         self.building_room_map = {}
+        self.zero_u_racks = None
+        self.dictionary = None
+        self.changes = None
+
+    @property
+    def con(self):
+        # phases run in parallel, and a MySQL connection must not be shared between threads
+        return getattr(self.local, 'con', None)
+
+    @con.setter
+    def con(self, value):
+        self.local.con = value
 
     def connect(self):
         """
         Connection to RT database
         :return:
         """
+        if getattr(conf, 'DB_STREAMING', False):
+            cursorclass = TimedSSCursor
+        else:
+            cursorclass = TimedCursor
         self.con = sql.connect(host=conf.DB_IP, port=int(conf.DB_PORT),
-                               db=conf.DB_NAME, user=conf.DB_USER, passwd=conf.DB_PWD)
+                               db=conf.DB_NAME, user=conf.DB_USER, passwd=conf.DB_PWD, cursorclass=cursorclass)
+
+    def query(self, q, args=None):
+        """
+        Run a query and iterate over its rows.
+        With DB_STREAMING the rows are streamed from the server instead of being fetched at once. The
+        connection cannot run another query until all rows are read, so lookups have to be loaded first.
+        :return: generator of rows
+        """
+        if not self.con:
+            self.connect()
+        with self.con:
+            cur = self.con.cursor()
+            try:
+                cur.execute(q, args)
+                for row in cur:
+                    yield row
+            finally:
+                cur.close()
 
     @staticmethod
-    def convert_ip(ip_raw):
+    def debug_rows(title, rows):
         """
-        IP address conversion to human readable format
-        :param ip_raw:
-        :return:
+        Write rows to the debug log while they are read, see DebugTap.
+        :return: rows
         """
-        ip = socket.inet_ntoa(struct.pack('!I', ip_raw))
-        return ip
+        if conf.DEBUG and conf.DEBUG_LOG:
+            return DebugTap(title).tap(rows)
+        return rows
 
-    def get_ips(self):
+    def get_mark(self):
         """
-        Fetch IPs from RT and send them to upload function
-        :return:
+        :return: RackTables server time and highest object ID, the high-water mark of this run
         """
-        adrese = []
         if not self.con:
             self.connect()
         with self.con:
             cur = self.con.cursor()
-            q = 'SELECT * FROM IPv4Address WHERE IPv4Address.name != ""'
-            cur.execute(q)
-            ips = cur.fetchall()
-            if conf.DEBUG:
-                msg = ('IPs', str(ips))
-                logger.debugger(msg)
-
-        for line in ips:
-            net = {}
-            ip_raw, name, comment, reserved = line
-            ip = self.convert_ip(ip_raw)
-            adrese.append(ip)
+            cur.execute('SELECT NOW(), MAX(id) FROM Object')
+            now, max_id = cur.fetchone()
+        return str(now)[:19], int(max_id or 0)
+
+    def get_changes(self, since, max_object_id):
+        """
+        Read RT's change history since the high-water mark of the last run.
+        Only changed objects, ports and IPs are uploaded afterwards, see `changed`.
+        """
+        changes = ChangeSet(since, max_object_id)
+        if not self.con:
+            self.connect()
+        for kind, q in ChangeSet.QUERIES:
+            try:
+                with self.con:
+                    cur = self.con.cursor()
+                    cur.execute(q, (since,))
+                    getattr(changes, kind).update(x[0] for x in cur.fetchall())
+            except sql.ProgrammingError as e:
+                # table missing in older RT versions
+                msg = '\n[!] Cannot read RT change history: %s' % str(e)
+                logger.writer(msg, Logger.WARNING)
+        self.changes = changes
+
+        msg = '\n[!] Incremental run: %d objects, %d ports, %d IPv4 and %d IPv6 addresses changed since %s' % (
+            len(changes.objects), len(changes.ports), len(changes.ips), len(changes.ips6), since)
+        logger.writer(msg)
+
+    def changed(self, object_id):
+        """
+        :return: True if the object has to be uploaded. Always True if the run is not incremental.
+        """
+        return self.changes is None or self.changes.has_object(object_id)
 
+    @staticmethod
+    def convert_ips(values):
+        """
+        Convert IPv4 addresses stored as integers to dotted strings, a whole column at a time
+        (one struct call for all addresses instead of one per address).
+        :param values: list of integers
+        :return: list of strings
+        """
+        packed = struct.pack('!%dI' % len(values), *values)
+        return map(socket.inet_ntoa, [packed[i:i + 4] for i in xrange(0, len(packed), 4)])
+
+    @staticmethod
+    def convert_ipv6s(values):
+        """
+        Convert IPv6 addresses stored as 16 byte strings to text. Unlike convert_ips this calls inet_ntop once
+        per address: there is no packed form to convert at once, and inet_ntop is still about 7 times faster than
+        format_ipv6s. Python 2 has no socket.inet_ntop on Windows, format_ipv6s gives the same text there.
+        :param values: list of 16 byte strings
+        :return: list of strings
+        """
+        if hasattr(socket, 'inet_ntop'):
+            return [socket.inet_ntop(socket.AF_INET6, x) for x in values]
+        return DB.format_ipv6s(values)
+
+    @staticmethod
+    def format_ipv6s(values):
+        """
+        Format IPv6 addresses like inet_ntop, only used where inet_ntop is missing. The longest run of two or more
+        zero groups (the first of equal runs) is replaced with '::', and IPv4-mapped and IPv4-compatible addresses
+        end in a dotted IPv4 address.
+        :param values: list of 16 byte strings
+        :return: list of strings
+        """
+        if not values:
+            return []
+        groups = struct.unpack('!%dH' % (8 * len(values)), ''.join(values))
+        # all eight groups of every address, each group enclosed in colons
+        full = ((':%x:%x:%x:%x:%x:%x:%x:%x:,' * len(values))[:-1] % groups).split(',')
+        addresses = []
+        for i, text in enumerate(full):
+            g = groups[8 * i:8 * i + 8]
+            if g[:5] == IPV6_ZEROS_V4 and (g[5] == 0xffff or g[5] == 0 and g[6]):
+                addresses.append('::%s%d.%d.%d.%d' % (('ffff:' if g[5] else ''), g[6] >> 8, g[6] & 0xff,
+                                                       g[7] >> 8, g[7] & 0xff))
+                continue
+            for zeros in IPV6_ZEROS:
+                start = text.find(zeros)
+                if start >= 0:
+                    text = text[1:start] + '::' + text[start + len(zeros):-1]
+                    break
+            else:
+                text = text[1:-1]
+            addresses.append(text)
+        return addresses
+
+    @staticmethod
+    def addresses(rows, column, convert):
+        """
+        Append the text form of the address in `column` to every row.
+        Rows are converted ADDRESS_CHUNK at a time, so that streamed rows stay streamed.
+        :param convert: convert_ips or convert_ipv6s
+        :return: generator of rows
+        """
+        rows = iter(rows)
+        while 1:
+            chunk = list(itertools.islice(rows, ADDRESS_CHUNK))
+            if not chunk:
+                break
+            for row, address in zip(chunk, convert([x[column] for x in chunk])):
+                yield tuple(row) + (address,)
+
+    def get_ips(self):
+        """
+        Fetch named IP addresses and IP allocations from RT and upload every address once.
+        Both tables are read in one query, sorted by address, so that the rows of an address follow each other.
+        :return:
+        """
+        q = """SELECT ip, name, NULL, NULL, 0 AS allocated
+                FROM IPv4Address
+                WHERE IPv4Address.name != ''
+                UNION ALL
+                SELECT IPv4Allocation.ip, IPv4Allocation.name, Object.name, IPv4Allocation.object_id, 1
+                FROM IPv4Allocation
+                LEFT JOIN Object ON Object.id = IPv4Allocation.object_id
+                ORDER BY 1, 5, 4"""
+        ips = self.addresses(self.debug_rows('IPs', self.query(q)), 0, self.convert_ips)
+        uploads.consume(rest.post_ip, self.ip_payloads(ips, self.changes and self.changes.ips))
+
+    def get_ipv6_ips(self):
+        """
+        Fetch named IPv6 addresses and IPv6 allocations from RT and upload every address once, like get_ips.
+        :return:
+        """
+        q = """SELECT ip, name, NULL, NULL, 0 AS allocated
+                FROM IPv6Address
+                WHERE IPv6Address.name != ''
+                UNION ALL
+                SELECT IPv6Allocation.ip, IPv6Allocation.name, Object.name, IPv6Allocation.object_id, 1
+                FROM IPv6Allocation
+                LEFT JOIN Object ON Object.id = IPv6Allocation.object_id
+                ORDER BY 1, 5, 4"""
+        ips = self.addresses(self.debug_rows('IPv6 IPs', self.query(q)), 0, self.convert_ipv6s)
+        uploads.consume(rest.post_ip, self.ip_payloads(ips, self.changes and self.changes.ips6))
+
+    def ip_payloads(self, ips, changed_ips):
+        """
+        Merge the rows of an address into one payload. The NIC name of an allocation replaces the name of the address.
+        If an address is allocated to several devices, the last allocation wins.
+        :param changed_ips: addresses changed since the last run, None if the run is not incremental
+        """
+        for ip_raw, rows in itertools.groupby(ips, key=lambda x: x[0]):
+            net = {}
+            changed = changed_ips is None or ip_raw in changed_ips
+            for line in rows:
+                ip_raw, name, hostname, object_id, allocated, ip = line
+                if not allocated:
+                    net.update({'tag': name})
+                    continue
+                changed = changed or self.changed(object_id)
+                net.update({'device': hostname})
+                if name:
+                    net.update({'tag': name})
+            if not changed:
+                continue
             net.update({'ipaddress': ip})
             msg = 'IP Address: %s' % ip
             logger.writer(msg)
-
-            net.update({'tag': name})
-            msg = 'Label: %s' % name
-            logger.writer(msg)
-            rest.post_ip(net)
+            if 'tag' in net:
+                msg = 'Label: %s' % net['tag']
+                logger.writer(msg)
+            yield net
 
     def get_subnets(self):
         """
         Fetch subnets from RT and send them to upload function
         :return:
         """
-        subs = {}
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = "SELECT * FROM IPv4Network"
-            cur.execute(q)
-            subnets = cur.fetchall()
-            if conf.DEBUG:
-                msg = ('Subnets', str(subnets))
-                logger.debugger(msg)
+        subnets = self.query('SELECT id, ip, mask, name FROM IPv4Network')
+        subnets = self.addresses(self.debug_rows('Subnets', subnets), 1, self.convert_ips)
+        uploads.consume(rest.post_subnet, self.subnet_payloads(subnets))
+
+    def get_ipv6_subnets(self):
+        """
+        Fetch IPv6 subnets from RT and send them to upload function
+        :return:
+        """
+        subnets = self.query('SELECT id, ip, mask, name FROM IPv6Network')
+        subnets = self.addresses(self.debug_rows('IPv6 Subnets', subnets), 1, self.convert_ipv6s)
+        uploads.consume(rest.post_subnet, self.subnet_payloads(subnets))
+
+    def subnet_payloads(self, subnets):
         for line in subnets:
-            sid, raw_sub, mask, name, x = line
-            subnet = self.convert_ip(raw_sub)
-            subs.update({'network': subnet})
-            subs.update({'mask_bits': str(mask)})
-            subs.update({'name': name})
-            rest.post_subnet(subs)
+            sub = {}
+            sid, raw_sub, mask, name, subnet = line
+            sub.update({'network': subnet})
+            sub.update({'mask_bits': str(mask)})
+            sub.update({'name': name})
+            yield sub
 
     def get_infrastructure(self):
         """
@@ -360,15 +2074,9 @@ class DB:
         rows_map = {}
         racks = []
 
-        if not self.con:
-            self.connect()
-
         # ============ BUILDINGS AND ROOMS ============
-        with self.con:
-            cur = self.con.cursor()
-            q = """select id,name, parent_id, parent_name from Location"""
-            cur.execute(q)
-            raw = cur.fetchall()
+        q = """select id,name, parent_id, parent_name from Location"""
+        raw = self.query(q)
         if conf.CHILD_AS_BUILDING:
             for rec in raw:
                 building_id, building_name, parent_id, parent_name = rec
@@ -381,43 +2089,47 @@ class DB:
                 else:
                     rooms_map.update({building_name: parent_name})
         # get d42 racks
-        for d42_rack in rest.get_racks()['racks']:
+        if rest.index:
+            d42_racks = rest.index.records('/api/1.0/racks/')
+        else:
+            d42_racks = rest.get_racks()
+        for d42_rack in d42_racks:
             self.d42_racks.update({d42_rack['name']: d42_rack['rack_id']})
 
         # upload buildings
-        if conf.DEBUG:
-            msg = ('Buildings', str(buildings_map))
-            logger.debugger(msg)
-        bdata = {}
-        for bid, building in buildings_map.items():
-            bdata.update({'name': building})
-            rest.post_building(bdata)
+        bdata = []
+        for bid, building in self.debug_rows('Buildings', buildings_map.items()):
+            bdata.append({'name': building})
+        uploads.consume(rest.post_building, bdata)
 
         # upload rooms
-        buildings = json.loads((rest.get_buildings()))['buildings']
         if not conf.CHILD_AS_BUILDING:
+            rooms = []
             for room, parent in rooms_map.items():
                 roomdata = {}
                 roomdata.update({'name': room})
                 roomdata.update({'building': parent})
-                rest.post_room(roomdata)
+                rooms.append(roomdata)
+            uploads.consume(rest.post_room, rooms)
 
         # ============ ROWS AND RACKS ============
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT id, name ,height, row_id, row_name, location_id, location_name from Rack;"""
-            cur.execute(q)
-            raw = cur.fetchall()
+        q = """SELECT id, name ,height, row_id, row_name, location_id, location_name from Rack;"""
+        raw = self.query(q)
 
         for rec in raw:
             rack_id, rack_name, height, row_id, row_name, location_id, location_name = rec
 
             rows_map.update({row_name: location_name})
 
+            # unchanged racks that are in D42 already are not uploaded again
+            if not self.changed(rack_id) and rack_name in self.d42_racks:
+                self.rack_id_map.update({rack_id: self.d42_racks[rack_name]})
+                continue
+
             # prepare rack data. We will upload it a little bit later
             rack = {}
             rack.update({'name': rack_name})
-            if rack_name in self.d42_racks.keys():
+            if rack_name in self.d42_racks:
                 rack.update({'rack_id': self.d42_racks[rack_name]})
             rack.update({'size': height})
             rack.update({'rt_id': rack_id})  # we will remove this later
@@ -437,100 +2149,144 @@ class DB:
 
         # upload rows as rooms
         if conf.ROW_AS_ROOM:
-            if conf.DEBUG:
-                msg = ('Rooms', str(rows_map))
-                logger.debugger(msg)
-            for room, parent in rows_map.items():
+            rooms = []
+            for room, parent in self.debug_rows('Rooms', rows_map.items()):
                 roomdata = {}
                 roomdata.update({'name': room})
                 roomdata.update({'building': parent})
-                rest.post_room(roomdata)
+                rooms.append(roomdata)
+            uploads.consume(rest.post_room, rooms)
 
         # upload racks
-        if conf.DEBUG:
-            msg = ('Racks', str(racks))
-            logger.debugger(msg)
-        for rack in racks:
-            rt_rack_id = rack['rt_id']
-            del rack['rt_id']
-            response = rest.post_rack(rack)
-            d42_rack_id = response['msg'][1]
+        if rest.journal:
+            for rack in list(racks):
+                d42_rack_id = rest.journal.get_id('rack', rack['rt_id'])
+                if d42_rack_id is not None:
+                    self.rack_id_map.update({rack['rt_id']: d42_rack_id})
+                    racks.remove(rack)
+
+        rt_rack_ids = [rack.pop('rt_id') for rack in self.debug_rows('Racks', racks)]
+        responses = uploads.map(rest.post_rack, racks)
+        for rt_rack_id, response in zip(rt_rack_ids, responses):
+            d42_rack_id = rest.response_id(response)
+            if d42_rack_id is None:
+                msg = '\n[!] INFO: Rack with RT id %s was not uploaded: %s' % (str(rt_rack_id), str(response))
+                logger.writer(msg, Logger.WARNING)
+                continue
 
             self.rack_id_map.update({rt_rack_id: d42_rack_id})
+            if rest.journal:
+                rest.journal.add_id('rack', rt_rack_id, d42_rack_id)
 
-        self.all_ports = self.get_ports()
+        self.get_ports()
+        self.links = self.get_links()
 
     def get_hardware(self):
         """
         Get hardware from RT and send it to uploader
         :return:
         """
-        if not self.con:
-            self.connect()
-        with self.con:
-            # get hardware items (except PDU's)
-            cur = self.con.cursor()
-            q = """SELECT
-                    Object.id,Object.name as Description, Object.label as Name,
-                    Object.asset_no as Asset,Dictionary.dict_value as Type
-                    FROM Object
-                    LEFT JOIN AttributeValue ON Object.id = AttributeValue.object_id
-                    LEFT JOIN Attribute ON AttributeValue.attr_id = Attribute.id
-                    LEFT JOIN Dictionary ON Dictionary.dict_key = AttributeValue.uint_value
-                    WHERE Attribute.id=2 AND Object.objtype_id != 2
-                    """
-            cur.execute(q)
-        data = cur.fetchall()
-
-        if conf.DEBUG:
-            msg = ('Hardware', str(data))
-            logger.debugger(msg)
+        self.load_rackspace()
+        self.load_dictionary()
+        # get hardware items (except PDU's)
+        q = """SELECT
+                Object.id,Object.name as Description, Object.label as Name,
+                Object.asset_no as Asset,AttributeValue.uint_value as Type
+                FROM Object
+                JOIN AttributeValue ON Object.id = AttributeValue.object_id
+                WHERE AttributeValue.attr_id=2 AND Object.objtype_id != 2
+                """
+        data = self.debug_rows('Hardware', self.query(q))
 
-        # create map device_id:height
         # RT does not impose height for devices of the same hardware model so it might happen that -
         # two or more devices based on same HW model have different size in rack
-        # here we try to find and set smallest U for device
-        hwsize_map = {}
+        # here we try to find and set smallest U for every model
+        models = {}
         for line in data:
             line = [0 if not x else x for x in line]
             data_id, description, name, asset, dtype = line
-            size = self.get_hardware_size(data_id)
-            if size:
-                floor, height, depth, mount = size
-                if data_id not in hwsize_map:
-                    hwsize_map.update({data_id: height})
-                else:
-                    h = float(hwsize_map[data_id])
-                    if float(height) < h:
-                        hwsize_map.update({data_id: height})
+            decoded = self.decode(dtype)
+            if not decoded:
+                continue
+            hardware, vendor, model = decoded
+            model = model[:48]
 
-        for line in data:
-            hwddata = {}
-            line = [0 if not x else x for x in line]
-            data_id, description, name, asset, dtype = line
+            floor, height, depth, mount = self.get_hardware_size(data_id)
+            self.hardware_models.set_size(model, height, depth)
+            # devices refer to the model by its full name, see process_data
+            self.hardware_models.set_size(hardware[:48], height, depth)
 
-            if '%GPASS%' in dtype:
-                vendor, model = dtype.split("%GPASS%")
-            elif len(dtype.split()) > 1:
-                venmod = dtype.split()
-                vendor = venmod[0]
-                model = ' '.join(venmod[1:])
-            else:
-                vendor = dtype
-                model = dtype
-
-            size = self.get_hardware_size(data_id)
-            if size:
-                floor, height, depth, mount = size
-                # patching height
-                height = hwsize_map[data_id]
+            if model not in models and self.changed(data_id):
+                hwddata = {}
                 hwddata.update({'notes': description})
                 hwddata.update({'type': 1})
-                hwddata.update({'size': height})
-                hwddata.update({'depth': depth})
-                hwddata.update({'name': model[:48]})
+                hwddata.update({'name': model})
                 hwddata.update({'manufacturer': vendor})
-                rest.post_hardware(hwddata)
+                models.update({model: hwddata})
+
+        uploads.consume(self.hardware_models.post, models.values())
+
+    def get_rackspace(self):
+        """
+        Build the RackSpace occupancy index (object id -> floor, height, depth, mount) with one query.
+        :return:
+        """
+        q = """SELECT
+                object_id,
+                MIN(unit_no),
+                SUM(atom = 'front'),
+                SUM(atom = 'interior'),
+                SUM(atom = 'rear')
+                FROM RackSpace
+                WHERE object_id IS NOT NULL
+                GROUP BY object_id"""
+
+        rackspace = {}
+        for line in self.query(q):
+            object_id, flr, front, interior, rear = line
+            floor = int(flr) - 1  # '-1' since RT rack starts at 1 and Device42 starts at 0.
+            rackspace.update({object_id: self.calculate_size(floor, int(front), int(interior), int(rear))})
+        return rackspace
+
+    @staticmethod
+    def calculate_size(floor, front, interior, rear):
+        """
+        Calculate hardware size from the number of occupied atoms.
+        :return:
+            floor   - starting U location for the device in the rack
+            height  - height of the device
+            depth   - depth of the device (full, half)
+            mount   - orientation of the device in the rack. Can be front or back
+        """
+        depth = 1  # 1 for full depth (default) and 2 for half depth
+        mount = 'front'  # can be [front | rear]
+
+        if front and interior and rear:  # full depth
+            height = front
+            return floor, height, depth, mount
+
+        elif front and interior and not rear:  # half depth, front mounted
+            height = front
+            depth = 2
+            return floor, height, depth, mount
+
+        elif interior and rear and not front:  # half depth,  rear mounted
+            height = rear
+            depth = 2
+            mount = 'rear'
+            return floor, height, depth, mount
+
+        # for devices that look like less than half depth:
+        elif front and not interior and not rear:
+            height = front
+            depth = 2
+            return floor, height, depth, mount
+        elif rear and not interior and not front:
+            height = rear
+            depth = 2
+            return floor, height, depth, mount
+        else:
+            return None, None, None, None
 
     def get_hardware_size(self, data_id):
         """
@@ -542,73 +2298,52 @@ class DB:
             depth   - depth of the device (full, half)
             mount   - orientation of the device in the rack. Can be front or back
         """
-        if not self.con:
-            self.connect()
-        with self.con:
-            # get hardware items
-            cur = self.con.cursor()
-            q = """SELECT unit_no,atom FROM RackSpace WHERE object_id = %s""" % data_id
-            cur.execute(q)
-        data = cur.fetchall()
-        if data != ():
-            front = 0
-            interior = 0
-            rear = 0
-            floor = 0
-            depth = 1  # 1 for full depth (default) and 2 for half depth
-            mount = 'front'  # can be [front | rear]
-            i = 1
-
-            for line in data:
-                flr, tag = line
-
-                if i == 1:
-                    floor = int(flr) - 1  # '-1' since RT rack starts at 1 and Device42 starts at 0.
+        self.load_rackspace()
+        return self.rackspace.get(data_id, (None, None, None, None))
+
+    def load_rackspace(self):
+        """
+        Build the RackSpace index once. Phases that stream their rows load it before their query.
+        """
+        with self.lock:
+            if self.rackspace is None:
+                self.rackspace = self.get_rackspace()
+
+    def load_dictionary(self):
+        """
+        Read and decode the RT Dictionary once, instead of joining it in every query.
+        Queries select AttributeValue.uint_value and look it up with decode().
+        """
+        with self.lock:
+            if self.dictionary is not None:
+                return
+            dictionary = {}
+            for dict_key, value in self.query('SELECT dict_key, dict_value FROM Dictionary'):
+                if value is None:
+                    continue
+                display = value.replace('%GSKIP%', ' ').replace('%GPASS%', ' ').replace('\t', ' ')
+                if '%GPASS%' in value:
+                    vendor, model = value.split('%GPASS%', 1)
+                elif len(value.split()) > 1:
+                    venmod = value.split()
+                    vendor = venmod[0]
+                    model = ' '.join(venmod[1:])
                 else:
-                    if int(flr) < floor:
-                        floor = int(flr) - 1
-                i += 1
-                if tag == 'front':
-                    front += 1
-                elif tag == 'interior':
-                    interior += 1
-                elif tag == 'rear':
-                    rear += 1
-
-            if front and interior and rear:  # full depth
-                height = front
-                return floor, height, depth, mount
-
-            elif front and interior and not rear:  # half depth, front mounted
-                height = front
-                depth = 2
-                return floor, height, depth, mount
-
-            elif interior and rear and not front:  # half depth,  rear mounted
-                height = rear
-                depth = 2
-                mount = 'rear'
-                return floor, height, depth, mount
-
-            # for devices that look like less than half depth:
-            elif front and not interior and not rear:
-                height = front
-                depth = 2
-                return floor, height, depth, mount
-            elif rear and not interior and not front:
-                height = rear
-                depth = 2
-                return floor, height, depth, mount
-            else:
-                return None, None, None, None
-        else:
-            return None, None, None, None
+                    vendor = value
+                    model = value
+                dictionary.update({dict_key: (display, vendor, model)})
+            self.dictionary = dictionary
 
-    @staticmethod
-    def add_hardware(height, depth, name):
+    def decode(self, uint_value):
         """
+        :return: display string, vendor and model of a Dictionary value, or None if there is none
+        """
+        self.load_dictionary()
+        return self.dictionary.get(uint_value)
 
-        :rtype : object
+    def add_hardware(self, height, depth, name):
+        """
+        Post hardware model of a device, unless it was already posted.
         """
         hwddata = {}
         hwddata.update({'type': 1})
@@ -618,49 +2353,34 @@ class DB:
             hwddata.update({'depth': depth})
         if name:
             hwddata.update({'name': name[:48]})
-            rest.post_hardware(hwddata)
+            self.hardware_models.post(hwddata)
 
     def get_vmhosts(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT id, name FROM Object WHERE objtype_id='1505'"""
-            cur.execute(q)
-            raw = cur.fetchall()
-
-        dev = {}
-        for rec in raw:
-            host_id = int(rec[0])
-            try:
-                name = rec[1].strip()
-            except AttributeError:
-                continue
-            self.vm_hosts.update({host_id: name})
-            dev.update({'name': name})
-            dev.update({'is_it_virtual_host': 'yes'})
-            rest.post_device(dev)
+        raw = self.query("""SELECT id, name FROM Object WHERE objtype_id='1505'""")
+        uploads.consume(rest.post_device, self.host_payloads(raw, self.vm_hosts, 'is_it_virtual_host'))
 
     def get_chassis(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT id, name FROM Object WHERE objtype_id='1502'"""
-            cur.execute(q)
-            raw = cur.fetchall()
+        raw = self.query("""SELECT id, name FROM Object WHERE objtype_id='1502'""")
+        uploads.consume(rest.post_device, self.host_payloads(raw, self.chassis, 'is_it_blade_host'))
 
-        dev = {}
+    def host_payloads(self, raw, hosts, flag):
+        """
+        :param hosts: map of host ids to names, filled while the rows are read
+        :param flag: 'is_it_virtual_host' or 'is_it_blade_host'
+        """
         for rec in raw:
+            dev = {}
             host_id = int(rec[0])
             try:
                 name = rec[1].strip()
             except AttributeError:
                 continue
-            self.chassis.update({host_id: name})
+            hosts.update({host_id: name})
+            if not self.changed(host_id):
+                continue
             dev.update({'name': name})
-            dev.update({'is_it_blade_host': 'yes'})
-            rest.post_device(dev)
+            dev.update({flag: 'yes'})
+            yield dev
 
     def get_container_map(self):
         """
@@ -668,60 +2388,46 @@ class DB:
         Which Blade goes into which Chassis ?
         :return:
         """
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT parent_entity_id AS container_id, child_entity_id AS object_id
-                    FROM EntityLink WHERE child_entity_type='object' AND parent_entity_type = 'object'"""
-            cur.execute(q)
-            raw = cur.fetchall()
-        for rec in raw:
+        q = """SELECT parent_entity_id AS container_id, child_entity_id AS object_id
+                FROM EntityLink WHERE child_entity_type='object' AND parent_entity_type = 'object'"""
+        for rec in self.query(q):
             container_id, object_id = rec
             self.container_map.update({object_id: container_id})
 
     def get_devices(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            # get object IDs
-            q = 'SELECT id FROM Object'
-            cur.execute(q)
-            idsx = cur.fetchall()
-        ids = [x[0] for x in idsx]
+        self.load_rackspace()
+        self.load_dictionary()
+        # all device rows in one query, grouped by object id below
+        q = """Select
+                    Object.id,
+                    Object.objtype_id,
+                    Object.name as Description,
+                    Object.label as Name,
+                    Object.asset_no as Asset,
+                    Attribute.name as Name,
+                    AttributeValue.uint_value as Type,
+                    Object.comment as Comment,
+                    RackSpace.rack_id as RackID,
+                    Rack.name as rack_name,
+                    Rack.row_name,
+                    Rack.location_id,
+                    Rack.location_name,
+                    Location.parent_name
 
-        with self.con:
-            for dev_id in ids:
-                q = """Select
-                            Object.objtype_id,
-                            Object.name as Description,
-                            Object.label as Name,
-                            Object.asset_no as Asset,
-                            Attribute.name as Name,
-                            Dictionary.dict_value as Type,
-                            Object.comment as Comment,
-                            RackSpace.rack_id as RackID,
-                            Rack.name as rack_name,
-                            Rack.row_name,
-                            Rack.location_id,
-                            Rack.location_name,
-                            Location.parent_name
-
-                            FROM Object
-                            LEFT JOIN AttributeValue ON Object.id = AttributeValue.object_id
-                            LEFT JOIN Attribute ON AttributeValue.attr_id = Attribute.id
-                            LEFT JOIN RackSpace ON Object.id = RackSpace.object_id
-                            LEFT JOIN Dictionary ON Dictionary.dict_key = AttributeValue.uint_value
-                            LEFT JOIN Rack ON RackSpace.rack_id = Rack.id
-                            LEFT JOIN Location ON Rack.location_id = Location.id
-                            WHERE Object.id = %s
-                            AND Object.objtype_id not in (2,9,1505,1560,1561,1562,50275)""" % dev_id
-
-                cur.execute(q)
-                data = cur.fetchall()
-                if data:  # RT objects that do not have data are locations, racks, rows etc...
-                    self.process_data(data, dev_id)
+                    FROM Object
+                    LEFT JOIN AttributeValue ON Object.id = AttributeValue.object_id
+                    LEFT JOIN Attribute ON AttributeValue.attr_id = Attribute.id
+                    LEFT JOIN RackSpace ON Object.id = RackSpace.object_id
+                    LEFT JOIN Rack ON RackSpace.rack_id = Rack.id
+                    LEFT JOIN Location ON Rack.location_id = Location.id
+                    WHERE Object.objtype_id not in (2,9,1505,1560,1561,1562,50275)
+                    ORDER BY Object.id"""
+        data = self.query(q)
+
+        # RT objects that do not have data are locations, racks, rows etc...
+        for dev_id, rows in itertools.groupby(data, key=lambda x: x[0]):
+            if self.changed(dev_id):
+                self.process_data([x[1:] for x in rows], dev_id)
 
     def process_data(self, data, dev_id):
         devicedata = {}
@@ -744,36 +2450,13 @@ class DB:
             serial_no = x[3]
             note = x[-7]
 
-            if 'Operating System' in x:
-                opsys = x[-8]
-                if '%GSKIP%' in opsys:
-                    opsys = opsys.replace('%GSKIP%', ' ')
-                if '%GPASS%' in opsys:
-                    opsys = opsys.replace('%GPASS%', ' ')
-            if 'SW type' in x:
-                opsys = x[-8]
-                if '%GSKIP%' in opsys:
-                    opsys = opsys.replace('%GSKIP%', ' ')
-                if '%GPASS%' in opsys:
-                    opsys = opsys.replace('%GPASS%', ' ')
-
-            if 'Server Hardware' in x:
-                hardware = x[-8]
-                if '%GSKIP%' in hardware:
-                    hardware = hardware.replace('%GSKIP%', ' ')
-                if '%GPASS%' in hardware:
-                    hardware = hardware.replace('%GPASS%', ' ')
-                if '\t' in hardware:
-                    hardware = hardware.replace('\t', ' ')
-
-            if 'HW type' in x:
-                hardware = x[-8]
-                if '%GSKIP%' in hardware:
-                    hardware = hardware.replace('%GSKIP%', ' ')
-                if '%GPASS%' in hardware:
-                    hardware = hardware.replace('%GPASS%', ' ')
-                if '\t' in hardware:
-                    hardware = hardware.replace('\t', ' ')
+            if rattr_name in ('Operating System', 'SW type', 'Server Hardware', 'HW type'):
+                decoded = self.decode(rtype)
+                value = decoded[0] if decoded else None
+                if rattr_name in ('Operating System', 'SW type'):
+                    opsys = value
+                else:
+                    hardware = value
             if note:
                 note = note.replace('\n', ' ')
                 if '&lt;' in note:
@@ -820,7 +2503,7 @@ class DB:
             # except VMs
             if dev_type != 1504:
                 if rrack_id:
-                    d42_rack_id = self.rack_id_map[rrack_id]
+                    d42_rack_id = self.rack_id_map.get(rrack_id)
 
                 # if the device is mounted in RT, we will try to add it to D42 hardwares.
                 floor, height, depth, mount = self.get_hardware_size(dev_id)
@@ -843,68 +2526,6 @@ class DB:
 
                 rest.post_device(devicedata)
 
-                # update ports
-                if dev_type in [8, 7, 4, 445, 1055, 1644]:
-                    ports = self.get_ports_by_device(self.all_ports, dev_id)
-                    if ports:
-                        for item in ports:
-                            switchport_data = {
-                                'port': item[0],
-                                'switch': name,
-                                'label': item[1]
-                            }
-
-                            get_links = self.get_links(item[3])
-                            if get_links:
-                                device_name = self.get_device_by_port(get_links[0])
-                                switchport_data.update({'device': device_name})
-                                switchport_data.update({'remote_device': device_name})
-                                switchport_data.update({'remote_port': self.get_port_by_id(self.all_ports, get_links[0])})
-                                if item[6]:
-                                    switchport_data.update({'hwaddress': item[6]})
-
-                                sp = rest.post_switchport(switchport_data)
-                                if item[5]:
-                                    rest.put_switchport_cf({
-                                        'id': sp['msg'][1],
-                                        'key': 'cable_id',
-                                        'value': item[5]
-                                    })
-
-                                # reverse connection
-                                device_name = self.get_device_by_port(get_links[0])
-                                switchport_data = {
-                                    'port': self.get_port_by_id(self.all_ports, get_links[0]),
-                                    'switch': device_name
-                                }
-
-                                switchport_data.update({'device': name})
-                                switchport_data.update({'remote_device': name})
-                                switchport_data.update({'remote_port': item[0]})
-                                if item[6]:
-                                    switchport_data.update({'hwaddress': item[6]})
-
-                                sp = rest.post_switchport(switchport_data)
-                                if item[5]:
-                                    rest.put_switchport_cf({
-                                        'id': sp['msg'][1],
-                                        'key': 'cable_id',
-                                        'value': item[5]
-                                    })
-
-                            else:
-                                if item[6]:
-                                    switchport_data.update({'hwaddress': item[6]})
-
-                                sp = rest.post_switchport(switchport_data)
-                                if item[5]:
-                                    rest.put_switchport_cf({
-                                        'id': sp['msg'][1],
-                                        'key': 'cable_id',
-                                        'value': item[5]
-                                    })
-
-
                 # if there is a device, we can try to mount it to the rack
                 if dev_type != 1504 and d42_rack_id and floor:  # rack_id is D42 rack id
                     device2rack.update({'device': name})
@@ -931,56 +2552,114 @@ class DB:
             \n[!] INFO: Device with RT id=%d cannot be migrated because it has no name.' % dev_id
             logger.writer(msg)
 
-    def get_device_to_ip(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            # get hardware items (except PDU's)
-            cur = self.con.cursor()
-            q = """SELECT
-                    IPv4Allocation.ip,IPv4Allocation.name,
-                    Object.name as hostname
-                    FROM %s.`IPv4Allocation`
-                    LEFT JOIN Object ON Object.id = object_id""" % conf.DB_NAME
-            cur.execute(q)
-        data = cur.fetchall()
+    def get_switchports(self):
+        """
+        Upload ports of switch-like devices.
+        Every port is posted once, even if both ends of a link belong to switch-like devices.
+        Cable IDs are set in batches, once the switchport IDs are known.
+        :return:
+        """
+        q = """SELECT id, name FROM Object WHERE objtype_id IN (8, 7, 4, 445, 1055, 1644)"""
+        raw = self.query(q)
+
+        batch_size = int(getattr(conf, 'SWITCHPORT_BATCH_SIZE', 500))
+        posted = set()
+        switchports = []
+        for dev_id, name in raw:
+            if not name:
+                continue  # device has no name thus it was not migrated
+            device_changed = self.changed(dev_id)
+            for item in self.get_ports_by_device(dev_id):
+                if item[3] in posted:
+                    continue
+                link = self.links.get(item[3])
+                if not device_changed and item[3] not in self.changes.ports and \
+                        not (link and link[0] in self.changes.ports):
+                    continue
+                posted.add(item[3])
+                switchports.append(self.get_switchport_data(item, name, link))
+
+                # the other end of the link
+                if link:
+                    peer_port_id, peer_port_name, device_name, cable = link
+                    peer = self.ports_by_id.get(peer_port_id)
+                    if peer and device_name and peer_port_id not in posted:
+                        posted.add(peer_port_id)
+                        switchports.append(self.get_switchport_data(peer, device_name, (item[3], item[0], name, cable)))
+
+                if len(switchports) >= batch_size:
+                    self.post_switchports(switchports)
+                    switchports = []
+        self.post_switchports(switchports)
 
-        if conf.DEBUG:
-            msg = ('Device to IP', str(data))
-            logger.debugger(msg)
+    @staticmethod
+    def get_switchport_data(item, name, link):
+        """
+        :param item: port row, see get_ports
+        :param name: name of the device the port belongs to
+        :param link: link of the port, see get_links
+        :return: port id, switchport data and cable id
+        """
+        switchport_data = {
+            'port': item[0],
+            'switch': name,
+            'label': item[1]
+        }
+        cable = item[5]
+        if link:
+            peer_port_id, peer_port_name, device_name, cable = link
+            switchport_data.update({'device': device_name})
+            switchport_data.update({'remote_device': device_name})
+            switchport_data.update({'remote_port': peer_port_name})
+        if item[6]:
+            switchport_data.update({'hwaddress': item[6]})
+        return item[3], switchport_data, cable
 
-        for line in data:
-            devmap = {}
-            rawip, nic_name, hostname = line
-            ip = self.convert_ip(rawip)
-            devmap.update({'ipaddress': ip})
-            devmap.update({'device': hostname})
-            if nic_name:
-                devmap.update({'tag': nic_name})
-            rest.post_ip(devmap)
+    @staticmethod
+    def post_switchports(switchports):
+        ids = {}
+        if rest.journal:
+            for port_id, switchport_data, cable in switchports:
+                sp_id = rest.journal.get_id('switchport', port_id)
+                if sp_id is not None:
+                    ids.update({port_id: sp_id})
+
+        todo = [x for x in switchports if x[0] not in ids]
+        responses = uploads.map(rest.post_switchport, [x[1] for x in todo])
+        for (port_id, switchport_data, cable), sp in zip(todo, responses):
+            sp_id = rest.response_id(sp)
+            if sp_id is None:
+                msg = '\n[!] INFO: Switchport with RT id %s was not uploaded: %s' % (str(port_id), str(sp))
+                logger.writer(msg, Logger.WARNING)
+                continue
+            ids.update({port_id: sp_id})
+            if rest.journal:
+                rest.journal.add_id('switchport', port_id, sp_id)
+
+        cables = []
+        for port_id, switchport_data, cable in switchports:
+            if cable and port_id in ids:
+                cables.append({
+                    'id': ids[port_id],
+                    'key': 'cable_id',
+                    'value': cable
+                })
+        uploads.consume(rest.put_switchport_cf, cables)
 
     def get_pdus(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT
-                    Object.id,Object.name as Name, Object.asset_no as Asset,
-                    Object.comment as Comment, Dictionary.dict_value as Type, RackSpace.atom as Position,
-                    (SELECT Object.id FROM Object WHERE Object.id = RackSpace.rack_id) as RackID
-                    FROM Object
-                    LEFT JOIN AttributeValue ON Object.id = AttributeValue.object_id
-                    LEFT JOIN Attribute ON AttributeValue.attr_id = Attribute.id
-                    LEFT JOIN Dictionary ON Dictionary.dict_key = AttributeValue.uint_value
-                    LEFT JOIN RackSpace ON RackSpace.object_id = Object.id
-                    WHERE Object.objtype_id = 2
-                  """
-            cur.execute(q)
-        data = cur.fetchall()
-
-        if conf.DEBUG:
-            msg = ('PDUs', str(data))
-            logger.debugger(msg)
+        self.load_rackspace()
+        self.load_dictionary()
+        self.load_zero_u_racks()
+        q = """SELECT
+                Object.id,Object.name as Name, Object.asset_no as Asset,
+                Object.comment as Comment, AttributeValue.uint_value as Type, RackSpace.atom as Position,
+                (SELECT Object.id FROM Object WHERE Object.id = RackSpace.rack_id) as RackID
+                FROM Object
+                LEFT JOIN AttributeValue ON Object.id = AttributeValue.object_id
+                LEFT JOIN RackSpace ON RackSpace.object_id = Object.id
+                WHERE Object.objtype_id = 2
+              """
+        data = self.debug_rows('PDUs', self.query(q))
 
         rack_mounted = []
         pdumap = {}
@@ -992,11 +2671,12 @@ class DB:
             pdudata = {}
             line = ['' if x is None else x for x in line]
             pdu_id, name, asset, comment, pdu_type, position, rack_id = line
+            if not self.changed(pdu_id):
+                continue
 
-            if '%GPASS%' in pdu_type:
-                pdu_type = pdu_type.replace('%GPASS%', ' ')
+            decoded = self.decode(pdu_type)
+            pdu_type = decoded[0][:64] if decoded else ''
 
-            pdu_type = pdu_type[:64]
             pdudata.update({'name': name})
             pdudata.update({'notes': comment})
             pdudata.update({'pdu_model': pdu_type})
@@ -1017,10 +2697,20 @@ class DB:
                     pdu_rack_models.append(pdu_id)
 
             # post pdus
+            if pdu_id not in pdumap and rest.journal:
+                d42_pdu_id = rest.journal.get_id('pdu', pdu_id)
+                if d42_pdu_id is not None:
+                    pdumap.update({pdu_id: d42_pdu_id})
             if pdu_id not in pdumap:
                 response = rest.post_pdu(pdudata)
-                d42_pdu_id = response['msg'][1]
-                pdumap.update({pdu_id: d42_pdu_id})
+                d42_pdu_id = rest.response_id(response)
+                if d42_pdu_id is None:
+                    msg = '\n[!] INFO: PDU "%s" (RT id = %d) was not uploaded: %s' % (name, pdu_id, str(response))
+                    logger.writer(msg, Logger.WARNING)
+                else:
+                    pdumap.update({pdu_id: d42_pdu_id})
+                    if rest.journal:
+                        rest.journal.add_id('pdu', pdu_id, d42_pdu_id)
 
             # mount to rack
             if position:
@@ -1087,27 +2777,20 @@ class DB:
                         logger.writer(msg)
 
     def get_patch_panels(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT
-                   id,
-                   name,
-                   AttributeValue.uint_value
-                   FROM Object
-                   LEFT JOIN AttributeValue ON AttributeValue.object_id = id AND AttributeValue.attr_id = 6
-                   WHERE Object.objtype_id = 9
-                 """
-            cur.execute(q)
-        data = cur.fetchall()
-
-        if conf.DEBUG:
-            msg = ('PDUs', str(data))
-            logger.debugger(msg)
+        q = """SELECT
+               id,
+               name,
+               AttributeValue.uint_value
+               FROM Object
+               LEFT JOIN AttributeValue ON AttributeValue.object_id = id AND AttributeValue.attr_id = 6
+               WHERE Object.objtype_id = 9
+             """
+        data = self.debug_rows('PDUs', self.query(q))
 
         for item in data:
-            ports = self.get_ports_by_device(self.all_ports, item[0])
+            ports = self.get_ports_by_device(item[0])
+            if not self.changed(item[0]) and not [x for x in ports if x[3] in self.changes.ports]:
+                continue
             patch_type = 'singular'
             port_type = None
 
@@ -1146,125 +2829,272 @@ class DB:
             rest.post_patch_panel(payload)
 
     def get_ports(self):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT
-                    name,
-                    label,
-                    PortOuterInterface.oif_name,
-                    Port.id,
-                    object_id,
-                    Link.cable,
-                    l2address
-                    FROM Port
-                    LEFT JOIN Link ON Link.porta = Port.id
-                    LEFT JOIN PortOuterInterface ON PortOuterInterface.id = type"""
-            cur.execute(q)
-        data = cur.fetchall()
-
-        if data:
-            return data
-        else:
-            return False
+        q = """SELECT
+                name,
+                label,
+                PortOuterInterface.oif_name,
+                Port.id,
+                object_id,
+                Link.cable,
+                l2address
+                FROM Port
+                LEFT JOIN Link ON Link.porta = Port.id
+                LEFT JOIN PortOuterInterface ON PortOuterInterface.id = type"""
+        self.ports_by_device, self.ports_by_id = self.index_ports(self.query(q))
 
     @staticmethod
-    def get_ports_by_device(ports, device_id):
-        device_ports = []
-        for port in ports:
-            if port[4] == device_id:
-                device_ports.append(port)
-
-        return device_ports
-
-    @staticmethod
-    def get_port_by_id(ports, port_id):
+    def index_ports(ports):
+        """
+        Index ports for lookups by device and by port id.
+        :param ports: port rows, see get_ports
+        :return:
+            ports_by_device - object_id -> list of port rows
+            ports_by_id     - Port.id -> port row
+        """
+        ports_by_device = {}
+        ports_by_id = {}
         for port in ports:
-            if port[3] == port_id:
-                return port[0]
+            ports_by_device.setdefault(port[4], []).append(port)
+            ports_by_id.setdefault(port[3], port)
+        return ports_by_device, ports_by_id
 
-    def get_device_by_port(self, port_id):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT
-                    name
-                    FROM Object
-                    WHERE id = ( SELECT object_id FROM Port WHERE id = %s )""" % port_id
-            cur.execute(q)
-        data = cur.fetchone()
-        if data:
-            return data[0]
-        else:
-            return False
+    def get_ports_by_device(self, device_id):
+        return self.ports_by_device.get(device_id, [])
 
-    def get_links(self, port_id):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
-            q = """SELECT
-                    porta,
-                    portb
-                    FROM Link
-                    WHERE portb = %s""" % port_id
-            cur.execute(q)
-        data = cur.fetchall()
-
-        if data:
-            return data[0]
-        else:
-            with self.con:
-                cur = self.con.cursor()
-                q = """SELECT
-                        portb,
-                        porta
-                        FROM Link
-                        WHERE porta = %s""" % port_id
-                cur.execute(q)
-            data = cur.fetchall()
-
-            if data:
-                return data[0]
-            else:
-                return False
+    def get_links(self):
+        """
+        Load all links at once.
+        :return: port id -> (peer port id, peer port name, peer device name, cable)
+        """
+        q = """SELECT
+                Link.porta,
+                Link.portb,
+                Link.cable,
+                PortA.name,
+                PortB.name,
+                ObjectA.name,
+                ObjectB.name
+                FROM Link
+                LEFT JOIN Port AS PortA ON PortA.id = Link.porta
+                LEFT JOIN Port AS PortB ON PortB.id = Link.portb
+                LEFT JOIN Object AS ObjectA ON ObjectA.id = PortA.object_id
+                LEFT JOIN Object AS ObjectB ON ObjectB.id = PortB.object_id"""
+        data = self.query(q)
+
+        links = {}
+        for line in data:
+            porta, portb, cable, name_a, name_b, device_a, device_b = line
+            links.setdefault(porta, (portb, name_b, device_b, cable))
+            # a link where the port is "portb" takes precedence
+            links.update({portb: (porta, name_a, device_a, cable)})
+        return links
 
-    def get_rack_id_for_zero_us(self, pdu_id):
-        if not self.con:
-            self.connect()
-        with self.con:
-            cur = self.con.cursor()
+    def load_zero_u_racks(self):
+        """
+        Map objects to the racks they are linked to (Zero-U mounts) once,
+        instead of one query per PDU while the PDU rows are streamed.
+        """
+        with self.lock:
+            if self.zero_u_racks is not None:
+                return
             q = """SELECT
+                    EntityLink.child_entity_id,
                     EntityLink.parent_entity_id
                     FROM EntityLink
-                    WHERE EntityLink.child_entity_id = %s
-                    AND EntityLink.parent_entity_type = 'rack'""" % pdu_id
-            cur.execute(q)
-        data = cur.fetchone()
-        if data:
-            return data[0]
+                    WHERE EntityLink.parent_entity_type = 'rack'
+                    AND EntityLink.child_entity_type = 'object'"""
+            zero_u_racks = {}
+            for object_id, rack_id in self.query(q):
+                zero_u_racks.setdefault(object_id, rack_id)
+            self.zero_u_racks = zero_u_racks
+
+    def get_rack_id_for_zero_us(self, pdu_id):
+        self.load_zero_u_racks()
+        return self.zero_u_racks.get(pdu_id)
+
+
+def preflight():
+    """
+    Index the objects that exist in Device42, so that unchanged objects are not uploaded again.
+    """
+    if not getattr(conf, 'D42_INDEX', True) or rest.exporter:
+        return
+    context.phase = 'preflight'
+    metrics.phase_started(context.phase)
+    rest.index = D42Index()
+    rest.index.load_all()
+    metrics.phase_finished(context.phase)
+    context.phase = None
 
 
-def main():
+def replay(filename):
+    """
+    Send uploads exported with --export to Device42.
+    Runs of uploads to the same endpoint within a phase are sent in parallel. A run ends when the endpoint or
+    phase changes, when an upload needs the ID of an upload of the same run, or when it updates the same object
+    as an upload of the run (see REPLAY_KEYS). References to IDs are replaced with the IDs Device42 returned.
+    """
+    # first pass: which uploads are referenced by later ones
+    referenced = set()
+    with open(filename) as f:
+        for line in f:
+            referenced.update(json.loads(line)['deps'])
+
+    resolved = {}
+    preflight()
+
+    def send(record):
+        payload = {}
+        for k, v in record['payload'].items():
+            if isinstance(v, basestring) and v.startswith(Exporter.REF):
+                if v not in resolved:
+                    msg = '\n[!] INFO: Upload #%d skipped, upload %s it refers to has no ID' % (record['id'], v)
+                    logger.writer(msg, Logger.WARNING)
+                    return None
+                v = resolved[v]
+            payload.update({k: v})
+        return rest.uploader(payload, rest.base_url + record['endpoint'])
+
+    def flush(run):
+        responses = uploads.map(send, run)
+        for record, response in zip(run, responses):
+            ref = Exporter.REF + str(record['id'])
+            if ref in referenced:
+                d42_id = rest.response_id(response)
+                if d42_id is not None:
+                    resolved.update({ref: d42_id})
+                else:
+                    msg = '\n[!] INFO: Upload #%d returned no ID: %s' % (record['id'], str(response))
+                    logger.writer(msg, Logger.WARNING)
+
+    run = []
+    run_refs = set()
+    run_keys = set()
+    count = 0
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            key = object_key(record['endpoint'], record['payload'])
+            if run and (record['endpoint'] != run[0]['endpoint'] or record['phase'] != run[0]['phase'] or
+                        run_refs.intersection(record['deps']) or key in run_keys):
+                flush(run)
+                run = []
+                run_refs = set()
+                run_keys = set()
+            run.append(record)
+            run_refs.add(Exporter.REF + str(record['id']))
+            run_keys.add(key)
+            count += 1
+        flush(run)
+
+    msg = '\n[!] Replayed %d uploads from %s' % (count, filename)
+    logger.writer(msg)
+
+
+def main(incremental=False):
     db = DB()
-    db.get_subnets()
-    db.get_ips()
-    db.get_infrastructure()
-    db.get_hardware()
-    db.get_container_map()
-    db.get_chassis()
-    db.get_vmhosts()
-    db.get_device_to_ip()
-    db.get_pdus()
-    db.get_patch_panels()
-    db.get_devices()
+    state = None
+    if getattr(conf, 'STATE_FILE', 'migration.state'):
+        state = SyncState(getattr(conf, 'STATE_FILE', 'migration.state'))
+    mark, max_object_id = db.get_mark()
+    preflight()
+    if incremental:
+        last = state.get() if state else None
+        if last:
+            db.get_changes(*last)
+        else:
+            msg = '\n[!] No high-water mark of an earlier run found, migrating everything'
+            logger.writer(msg)
+    # phases run as soon as the data they require is available
+    phases = [
+        Phase('subnets', db.get_subnets, provides=['subnets']),
+        Phase('ips', db.get_ips, requires=['subnets'], provides=['ips']),
+        Phase('ipv6_subnets', db.get_ipv6_subnets, provides=['ipv6_subnets']),
+        Phase('ipv6_ips', db.get_ipv6_ips, requires=['ipv6_subnets'], provides=['ipv6_ips']),
+        Phase('infrastructure', db.get_infrastructure, provides=['rack_id_map', 'ports', 'links']),
+        Phase('hardware', db.get_hardware, provides=['hardware']),
+        Phase('container_map', db.get_container_map, provides=['container_map']),
+        Phase('chassis', db.get_chassis, provides=['chassis']),
+        Phase('vmhosts', db.get_vmhosts, provides=['vm_hosts']),
+        Phase('pdus', db.get_pdus, requires=['rack_id_map'], provides=['pdus']),
+        Phase('patch_panels', db.get_patch_panels, requires=['ports'], provides=['patch_panels']),
+        Phase('devices', db.get_devices,
+              requires=['rack_id_map', 'ports', 'links', 'hardware', 'container_map', 'chassis', 'vm_hosts'],
+              provides=['devices']),
+        Phase('switchports', db.get_switchports, requires=['devices', 'ports', 'links'], provides=['switchports']),
+    ]
+    scheduler = PhaseScheduler(phases, getattr(conf, 'PHASE_WORKERS', 1), rest.journal)
+    start = time.time()
+    scheduler.run()
+    if state and not rest.exporter:
+        # exported uploads reach Device42 only when they are replayed
+        state.set(mark, max_object_id)
+
+    path = scheduler.critical_path()
+    msg = '\n[!] Migration took %.1fs. Critical path: %s (%.1fs)' % (
+        time.time() - start, ' -> '.join('%s %.1fs' % (p.name, p.duration()) for p in path),
+        sum(p.duration() for p in path))
+    logger.writer(msg)
+
+    msg = '\n[!] Hardware models: %d posted, %d duplicate posts avoided' % (
+        len(db.hardware_models.posted), db.hardware_models.avoided)
+    logger.writer(msg)
+
+    if rest.index:
+        msg = '\n[!] Device42 index: %d uploads skipped, the objects were unchanged' % rest.index.skipped
+        logger.writer(msg)
+
+    reused, opened = rest.connection_stats()
+    msg = '\n[!] Device42 connections: %d opened, %d requests sent over reused connections' % (opened, reused)
+    logger.writer(msg)
+    msg = '[!] Device42 requests: %d retried, concurrency limit between %d and %d, now %d' % (
+        rest.retried, rest.limiter.lowest, rest.limiter.highest, int(rest.limiter.limit))
+    logger.writer(msg)
+
+    summary = metrics.summary()
+    for phase in phases:
+        stats = summary['phases'].get(phase.name)
+        if stats:
+            msg = '[!] Phase "%s": %.1fs, %d MySQL queries in %.1fs, %d Device42 requests in %.1fs' % (
+                phase.name, stats['wall_seconds'], stats['mysql_queries'], stats['mysql_seconds'],
+                stats['http_requests'], stats['http_seconds'])
+            logger.writer(msg)
+    return scheduler
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate RackTables data to Device42')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a migration that did not finish, skipping work recorded in the journal')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--export', metavar='FILE',
+                      help='write uploads to an NDJSON file instead of sending them to Device42')
+    mode.add_argument('--replay', metavar='FILE', help='send uploads exported with --export to Device42')
+    parser.add_argument('--incremental', action='store_true',
+                        help='upload only what changed in RackTables since the last finished run')
+    args = parser.parse_args()
+
     logger = Logger(conf.LOGFILE, conf.STDOUT)
     rest = REST()
-    main()
+    uploads = UploadPool(getattr(conf, 'UPLOAD_WORKERS', 1))
+    metrics = Metrics(getattr(conf, 'METRICS_JSON', ''), getattr(conf, 'METRICS_PROM', ''),
+                      getattr(conf, 'METRICS_INTERVAL', 60))
+    metrics.start()
+    if args.export:
+        rest.exporter = Exporter(args.export, rest.base_url)
+    elif getattr(conf, 'JOURNAL', ''):
+        rest.journal = Journal(conf.JOURNAL, args.resume)
+    try:
+        if args.replay:
+            replay(args.replay)
+        else:
+            main(args.incremental)
+    finally:
+        uploads.close()
+        metrics.stop()
+        if rest.journal:
+            rest.journal.close()
+        if rest.exporter:
+            rest.exporter.close()
     print '\n[!] Done!'
     sys.exit()
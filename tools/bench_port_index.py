@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark for port lookups done while migrating devices and patch panels.
+Compares a linear scan over all ports (used before the port index) with DB.index_ports.
+
+Run it from the directory that holds your conf file:
+    python tools/bench_port_index.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from racktables2device42 import DB
+
+PORTS_PER_DEVICE = 24
+SCALES = (250, 500, 1000, 2000, 4000, 8000)
+LINEAR_LIMIT = 1000  # linear scan gets too slow above this number of devices
+
+
+def make_ports(devices):
+    # same columns as DB.get_ports: name, label, oif_name, Port.id, object_id, cable, l2address
+    ports = []
+    port_id = 0
+    for device_id in range(1, devices + 1):
+        for n in range(PORTS_PER_DEVICE):
+            port_id += 1
+            ports.append(('eth%d' % n, '', '1000Base-T', port_id, device_id, None, None))
+    return ports
+
+
+# one lookup by device and one lookup by port id per device
+def linear(ports, devices):
+    for device_id in range(1, devices + 1):
+        device_ports = [port for port in ports if port[4] == device_id]
+        for port in ports:
+            if port[3] == device_ports[0][3]:
+                break
+
+
+def indexed(ports, devices):
+    ports_by_device, ports_by_id = DB.index_ports(ports)
+    for device_id in range(1, devices + 1):
+        device_ports = ports_by_device.get(device_id, [])
+        ports_by_id.get(device_ports[0][3])
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    print '%10s %10s %14s %14s' % ('devices', 'ports', 'linear [s]', 'indexed [s]')
+    for devices in SCALES:
+        ports = make_ports(devices)
+        if devices <= LINEAR_LIMIT:
+            linear_time = '%14.3f' % timed(linear, ports, devices)
+        else:
+            linear_time = '%14s' % '-'
+        print '%10d %10d %s %14.3f' % (devices, len(ports), linear_time, timed(indexed, ports, devices))
+
+
+if __name__ == '__main__':
+    main()
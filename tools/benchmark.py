@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end throughput benchmark. Migrates the RackTables database configured in conf
+to a local Device42 stand-in (tools/d42_standin.py) and reports objects/s and requests/s per phase.
+
+Run it from the directory that holds your conf file:
+    python tools/benchmark.py --latency 5 --upload-workers 8
+
+Requests are assigned to phases by time, so with more than one phase worker
+the numbers of phases that ran at the same time overlap.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import racktables2device42 as rt
+from d42_standin import StandIn
+
+
+def rate(count, seconds):
+    if seconds > 0:
+        return count / seconds
+    return 0.0
+
+
+def report(phases, stats, start, end):
+    line = '%-16s %9s %9s %10s %9s %10s %7s'
+    print line % ('phase', 'time [s]', 'objects', 'objects/s', 'requests', 'requests/s', 'errors')
+    rows = [(p.name, p.started, p.finished) for p in sorted(phases, key=lambda x: x.started)]
+    rows.append(('total', start, end))
+    for name, started, finished in rows:
+        requests = stats.between(started, finished)
+        objects = sum(x[3] for x in requests if x[1] in ('POST', 'PUT'))
+        errors = len([x for x in requests if x[4] >= 400])
+        seconds = finished - started
+        print '%-16s %9.2f %9d %10.1f %9d %10.1f %7d' % (
+            name, seconds, objects, rate(objects, seconds), len(requests), rate(len(requests), seconds), errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the migration against a local Device42 stand-in')
+    parser.add_argument('--latency', type=float, default=0, help='mean stand-in response delay in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of stand-in requests that fail')
+    parser.add_argument('--error-code', type=int, default=500, help='status code of failed requests')
+    parser.add_argument('--upload-workers', type=int, help='override UPLOAD_WORKERS from conf')
+    parser.add_argument('--phase-workers', type=int, default=1, help='PHASE_WORKERS, default 1')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='number of migrations against the same stand-in, later runs find its objects')
+    parser.add_argument('--incremental', action='store_true',
+                        help='incremental run against the STATE_FILE of conf, which is updated afterwards')
+    args = parser.parse_args()
+
+    server = StandIn(latency=args.latency, error_rate=args.error_rate, error_code=args.error_code)
+    server.start()
+
+    logdir = tempfile.mkdtemp(prefix='rt2d42-bench-')
+    rt.conf.D42_URL = server.url
+    rt.conf.LOGFILE = os.path.join(logdir, 'migration.log')
+    rt.conf.STDOUT = False
+    rt.conf.DEBUG = False
+    rt.conf.JOURNAL = ''
+    rt.conf.PHASE_WORKERS = args.phase_workers
+    if not args.incremental:
+        rt.conf.STATE_FILE = ''
+    if args.upload_workers:
+        rt.conf.UPLOAD_WORKERS = args.upload_workers
+
+    rt.logger = rt.Logger(rt.conf.LOGFILE, rt.conf.STDOUT)
+    rt.rest = rt.REST()
+    rt.uploads = rt.UploadPool(getattr(rt.conf, 'UPLOAD_WORKERS', 1))
+    rt.metrics = rt.Metrics(os.path.join(logdir, 'metrics.json'), '', 0)
+    print '[!] Stand-in at %s, migration log in %s' % (server.url, rt.conf.LOGFILE)
+
+    try:
+        for run in range(args.runs):
+            start = time.time()
+            scheduler = rt.main(args.incremental)
+            end = time.time()
+            if args.runs > 1:
+                print '\n[!] Run %d of %d' % (run + 1, args.runs)
+            report(scheduler.phases, server.stats, start, end)
+    finally:
+        rt.uploads.close()
+        rt.rest.adapter.close()
+        rt.metrics.stop()
+    print '[!] Metrics in %s' % rt.metrics.json_file
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Device42 API endpoints used by racktables2device42.py.
+Objects are kept in memory and responses have the same shape as the real ones,
+so migrations can be run and benchmarked without an appliance.
+
+    python tools/d42_standin.py --port 8042 --latency 20 --error-rate 0.01
+
+Then set D42_URL = 'http://127.0.0.1:8042' in conf.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+
+# endpoint -> (collection name used in GET responses, id field, fields that identify an object)
+ENDPOINTS = {
+    '/api/1.0/subnets/': ('subnets', 'subnet_id', ('network', 'mask_bits')),
+    '/api/ip/': ('ips', 'id', ('ipaddress',)),
+    '/api/1.0/device/': ('Devices', 'device_id', ('name',)),
+    '/api/1.0/buildings/': ('buildings', 'building_id', ('name',)),
+    '/api/1.0/rooms/': ('rooms', 'room_id', ('name', 'building')),
+    '/api/1.0/racks/': ('racks', 'rack_id', ('name', 'room', 'building')),
+    '/api/1.0/pdus/': ('pdus', 'pdu_id', ('name',)),
+    '/api/1.0/pdu_models/': ('pdu_models', 'pdu_model_id', ('name',)),
+    '/api/1.0/pdus/rack/': ('pdus_rack', 'id', ('pdu_id',)),
+    '/api/1.0/hardwares/': ('models', 'hardware_id', ('name',)),
+    '/api/1.0/device/rack/': ('device_rack', 'id', ('device',)),
+    '/api/1.0/switchports/': ('switchports', 'switchport_id', ('switch', 'port')),
+    '/api/1.0/custom_fields/switchport/': ('custom_fields', 'id', ('id', 'key')),
+    '/api/1.0/patch_panel_models/': ('patch_panel_models', 'patch_panel_model_id', ('name',)),
+    '/api/1.0/patch_panel_module_models/': ('patch_panel_module_models', 'id', ('name',)),
+}
+
+# GET endpoints that differ from the POST ones
+ALIASES = {
+    '/api/1.0/devices/': '/api/1.0/device/',
+    '/api/1.0/devices/all/': '/api/1.0/device/',
+    '/api/1.0/ips/': '/api/ip/',
+}
+
+# bulk endpoints: POST a JSON list of records to <endpoint>bulk/, the response is a list with one response per record
+BULK_SUFFIX = 'bulk/'
+
+# endpoints that change a part of another object: endpoint -> (endpoint of the object, payload field with its
+# name or ID, field of the object it matches). GET responses return the part with the object, like Device42 does.
+PARTS = {
+    '/api/1.0/device/rack/': ('/api/1.0/device/', 'device', 'name'),
+    '/api/1.0/pdus/rack/': ('/api/1.0/pdus/', 'pdu_id', 'pdu_id'),
+    '/api/1.0/custom_fields/switchport/': ('/api/1.0/switchports/', 'id', 'switchport_id'),
+}
+
+# fields that GET responses return under another name than the one they are posted with
+GET_FIELDS = {
+    '/api/1.0/device/': {'hardware': 'hw_model', 'virtual_host': 'virtual_host_name', 'blade_host': 'blade_host_name'},
+    '/api/ip/': {'ipaddress': 'ip', 'tag': 'label'},
+}
+
+
+class Store:
+    """
+    In-memory objects, one collection per endpoint. Posting an object with known identifying
+    fields updates it, like Device42 does.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = dict((endpoint, {}) for endpoint in ENDPOINTS)
+        self.order = dict((endpoint, []) for endpoint in ENDPOINTS)
+        self.by_id = {}  # ID -> object, IDs are unique across endpoints
+        self.next_id = 0
+
+    def upsert(self, endpoint, data):
+        collection, id_field, key_fields = ENDPOINTS[endpoint]
+        key = tuple(data.get(x) for x in key_fields)
+        with self.lock:
+            obj = self.objects[endpoint].get(key)
+            if obj is None:
+                self.next_id += 1
+                obj = {id_field: self.next_id}
+                self.objects[endpoint].update({key: obj})
+                self.order[endpoint].append(obj)
+                self.by_id.update({self.next_id: obj})
+            obj.update(data)
+            if endpoint in PARTS:
+                self.update_part(endpoint, data)
+            return obj[id_field], data.get(key_fields[0])
+
+    def update_part(self, endpoint, data):
+        owner_endpoint, field, owner_field = PARTS[endpoint]
+        value = data.get(field)
+        if owner_field == 'name':
+            owner = self.objects[owner_endpoint].get((value,))
+        else:
+            owner = self.by_id.get(int(value)) if str(value).isdigit() else None
+        if owner is None:
+            return
+        part = dict((k, v) for k, v in data.items() if k != field)
+        if 'key' in part:
+            # custom field
+            fields = [x for x in owner.get('custom_fields', []) if x['key'] != part['key']]
+            owner.update({'custom_fields': fields + [{'key': part['key'], 'value': part.get('value')}]})
+        else:
+            owner.update(part)
+
+    def page(self, endpoint, limit, offset):
+        fields = GET_FIELDS.get(endpoint, {})
+        with self.lock:
+            objects = self.order[endpoint]
+            if limit is None:
+                page = objects[offset:]
+            else:
+                page = objects[offset:offset + limit]
+            return [dict((fields.get(k, k), v) for k, v in obj.items()) for obj in page], len(objects)
+
+
+class Stats:
+    """
+    Log of handled requests: (time, method, endpoint, number of records, status code).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def add(self, method, endpoint, records, status):
+        with self.lock:
+            self.requests.append((time.time(), method, endpoint, records, status))
+
+    def between(self, start, end):
+        with self.lock:
+            return [x for x in self.requests if start <= x[0] <= end]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    # send status line, headers and body in one write, small writes stall on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def reply(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        if self.server.latency:
+            time.sleep(max(random.gauss(self.server.latency, self.server.latency / 4.0), 0) / 1000.0)
+
+    def failed(self, method, endpoint, records):
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.stats.add(method, endpoint, records, self.server.error_code)
+            self.reply(self.server.error_code, {'code': 1, 'msg': 'stand-in error'})
+            return True
+        return False
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        endpoint = url.path
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.delay()
+        if endpoint.endswith(BULK_SUFFIX) and endpoint[:-len(BULK_SUFFIX)] in ENDPOINTS:
+            return self.bulk(endpoint[:-len(BULK_SUFFIX)], body)
+        if endpoint not in ENDPOINTS:
+            self.server.stats.add(self.command, endpoint, 0, 404)
+            return self.reply(404, {'code': 1, 'msg': 'unknown endpoint %s' % endpoint})
+
+        data = dict((k, v[-1]) for k, v in urlparse.parse_qs(body, keep_blank_values=True).items())
+        if self.failed(self.command, endpoint, 1):
+            return
+        obj_id, name = self.server.store.upsert(endpoint, data)
+        self.server.stats.add(self.command, endpoint, 1, 200)
+        self.reply(200, {'code': 0, 'msg': ['%s added/updated.' % ENDPOINTS[endpoint][0], obj_id, name, True, True]})
+
+    do_PUT = do_POST
+
+    def bulk(self, endpoint, body):
+        try:
+            records = json.loads(body)
+        except ValueError:
+            records = None
+        if not isinstance(records, list):
+            self.server.stats.add(self.command, endpoint + BULK_SUFFIX, 0, 400)
+            return self.reply(400, {'code': 1, 'msg': 'expected a JSON list of records'})
+        if self.failed(self.command, endpoint + BULK_SUFFIX, len(records)):
+            return
+        responses = []
+        for data in records:
+            data = dict((k, unicode(v)) for k, v in data.items())
+            obj_id, name = self.server.store.upsert(endpoint, data)
+            responses.append({'code': 0, 'msg': ['%s added/updated.' % ENDPOINTS[endpoint][0], obj_id, name, True, True]})
+        self.server.stats.add(self.command, endpoint + BULK_SUFFIX, len(records), 200)
+        self.reply(200, responses)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        endpoint = ALIASES.get(url.path, url.path)
+        self.delay()
+        if endpoint == '/_stats':
+            return self.reply(200, {'requests': len(self.server.stats.requests)})
+        if endpoint not in ENDPOINTS:
+            self.server.stats.add(self.command, endpoint, 0, 404)
+            return self.reply(404, {'code': 1, 'msg': 'unknown endpoint %s' % endpoint})
+        if self.failed(self.command, endpoint, 0):
+            return
+
+        query = urlparse.parse_qs(url.query)
+        limit = int(query['limit'][0]) if 'limit' in query else None
+        offset = int(query['offset'][0]) if 'offset' in query else 0
+        objects, total = self.server.store.page(endpoint, limit, offset)
+        self.server.stats.add(self.command, endpoint, 0, 200)
+        body = {ENDPOINTS[endpoint][0]: objects, 'total_count': total, 'offset': offset}
+        if limit is not None:
+            body.update({'limit': limit})
+        self.reply(200, body)
+
+
+class StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Stand-in Device42 server.
+    :param latency: mean response delay in milliseconds
+    :param error_rate: fraction of requests that fail with error_code
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0, error_code=500, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.verbose = verbose
+        self.store = Store()
+        self.stats = Stats()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Device42 API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8042)
+    parser.add_argument('--latency', type=float, default=0, help='mean response delay in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail')
+    parser.add_argument('--error-code', type=int, default=500, help='status code of failed requests')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = StandIn(args.host, args.port, args.latency, args.error_rate, args.error_code, args.verbose)
+    print '[!] Device42 stand-in listening on %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,618 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic RackTables dataset generator for scale testing.
+Fills the RackTables database configured in conf with a reproducible set of objects:
+servers, switches and other network gear, VM hosts with VMs, chassis with blades, rack-mounted
+and Zero-U PDUs, patch panels, their rack space, ports, links and IPv4 and IPv6 networks, addresses and allocations,
+with change history. --change N edits objects of an existing dataset, to test incremental runs.
+
+Never point it at a production database!
+
+    python tools/rt_datagen.py --create-schema --objects 10000 --seed 42
+
+Run it from the directory that holds your conf file.
+"""
+
+import argparse
+import collections
+import imp
+import random
+import struct
+import sys
+import time
+
+import pymysql as sql
+
+# object types, see RackTables' Dictionary chapter 1
+SERVER = 4
+ROUTER = 7
+SWITCH = 8
+PATCH_PANEL = 9
+PDU = 2
+KVM = 445
+FC_SWITCH = 1055
+CONSOLE = 1644
+CHASSIS = 1502
+VM = 1504
+VM_HOST = 1505
+RACK = 1560
+ROW = 1561
+LOCATION = 1562
+
+# share of generated objects per type. VMs are placed into VM hosts.
+MIX = (
+    (SERVER, 0.38),
+    (VM, 0.25),
+    (SWITCH, 0.05),
+    (PDU, 0.05),
+    (PATCH_PANEL, 0.05),
+    (VM_HOST, 0.03),
+    (ROUTER, 0.02),
+    (CHASSIS, 0.01),
+    (KVM, 0.03),
+    (FC_SWITCH, 0.03),
+    (CONSOLE, 0.02),
+)
+BLADE_SHARE = 0.08  # servers in chassis
+UNNAMED_SHARE = 0.01  # objects without names are not migrated, but they exist in real databases
+IPV6_EVERY = 2  # every n-th IPv4 allocation comes with an IPv6 allocation
+IPV6_PREFIX = (0x2001, 0xdb8)  # documentation prefix, one /64 per IPv4 network below it
+
+OBJECTS_PER_RACK = 25
+RACKS_PER_ROW = 10
+RACK_HEIGHT = 42
+PORT_TYPES = ((24, '1000Base-T'), (1087, '10GBase-SR'), (1077, '10GBase-T'), (1603, 'SFP+'), (681, 'RJ-45'))
+
+VENDORS = {
+    SERVER: (('Dell', 'PowerEdge R%d', (1, 2)), ('HP', 'ProLiant DL%d G9', (1, 2)),
+             ('Supermicro', 'SYS-%dU', (1, 2, 4)), ('Lenovo', 'ThinkSystem SR%d', (1, 2))),
+    SWITCH: (('Cisco', 'Catalyst %d-48', (1,)), ('Juniper', 'EX%d-48T', (1,)), ('Arista', 'DCS-%d', (1, 2))),
+    ROUTER: (('Cisco', 'ASR %d', (2, 4)), ('Juniper', 'MX%d', (2, 4))),
+    CHASSIS: (('Dell', 'PowerEdge M%d', (10,)), ('HP', 'BladeSystem c%d', (10, 6))),
+    KVM: (('Avocent', 'DSR%d', (1,)),),
+    FC_SWITCH: (('Brocade', 'G%d', (1,)),),
+    CONSOLE: (('Opengear', 'CM%d', (1,)),),
+    PATCH_PANEL: (('Panduit', 'DP%d', (1, 2)),),
+    PDU: (('APC', 'AP%d', (1, 0)), ('Raritan', 'PX%d', (0,))),
+}
+OPERATING_SYSTEMS = ('RH Enterprise Linux%GSKIP%RHEL7', 'RH Enterprise Linux%GSKIP%RHEL8', 'Debian%GSKIP%Debian 11',
+                     'Ubuntu%GSKIP%Ubuntu 20.04', 'Windows%GSKIP%Windows Server 2019', 'VMware%GPASS%ESXi 7.0',
+                     'Cisco IOS 15', 'JunOS 20')
+
+# in insert order: rows come after the rows they refer to, a stock schema checks that with foreign keys
+COLUMNS = collections.OrderedDict((
+    ('Attribute', ('id', 'type', 'name')),
+    ('PortOuterInterface', ('id', 'oif_name')),
+    ('Dictionary', ('chapter_id', 'dict_key', 'dict_value')),
+    ('Object', ('id', 'name', 'label', 'objtype_id', 'asset_no', 'comment')),
+    ('EntityLink', ('parent_entity_type', 'parent_entity_id', 'child_entity_type', 'child_entity_id')),
+    ('AttributeValue', ('object_id', 'object_tid', 'attr_id', 'string_value', 'uint_value')),
+    ('RackSpace', ('rack_id', 'unit_no', 'atom', 'state', 'object_id')),
+    ('Port', ('id', 'object_id', 'name', 'iif_id', 'type', 'l2address', 'label')),
+    ('Link', ('porta', 'portb', 'cable')),
+    ('IPv4Network', ('id', 'ip', 'mask', 'name', 'comment')),
+    ('IPv4Address', ('ip', 'name', 'comment', 'reserved')),
+    ('IPv4Allocation', ('object_id', 'ip', 'name', 'type')),
+    ('IPv6Network', ('id', 'ip', 'mask', 'last_ip', 'name', 'comment')),
+    ('IPv6Address', ('ip', 'name', 'comment', 'reserved')),
+    ('IPv6Allocation', ('object_id', 'ip', 'name', 'type')),
+    ('ObjectHistory', ('id', 'name', 'label', 'objtype_id', 'asset_no', 'comment', 'ctime', 'user_name')),
+    ('ObjectLog', ('object_id', 'user', 'date', 'content')),
+    ('MountOperation', ('object_id', 'ctime', 'user_name', 'comment')),
+    ('PortLog', ('port_id', 'date', 'user', 'message')),
+    ('IPv4Log', ('ip', 'date', 'user', 'message')),
+    ('IPv6Log', ('ip', 'date', 'user', 'message')),
+))
+# reference data of RackTables: stock rows are kept (INSERT IGNORE), --clear leaves these tables alone
+REFERENCE_TABLES = ('Attribute', 'PortOuterInterface', 'Dictionary')
+# RackTables numbers Dictionary entries added by users after this key
+LAST_STOCK_DICT_KEY = 50000
+
+# generated history starts here, one second per object
+HISTORY_START = 1577836800  # 2020-01-01 00:00:00 UTC
+
+# simplified RackTables 0.20 schema: only the columns the migration reads and the generator writes
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS `Object` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `name` char(255) DEFAULT NULL, `label` char(255) DEFAULT NULL,
+        `objtype_id` int(10) unsigned NOT NULL DEFAULT '1', `asset_no` char(64) DEFAULT NULL,
+        `has_problems` enum('yes','no') NOT NULL DEFAULT 'no', `comment` text,
+        PRIMARY KEY (`id`), KEY `type_id` (`objtype_id`,`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `Dictionary` (
+        `chapter_id` int(10) unsigned NOT NULL, `dict_key` int(10) unsigned NOT NULL AUTO_INCREMENT,
+        `dict_sticky` enum('yes','no') DEFAULT 'no', `dict_value` char(255) DEFAULT NULL,
+        PRIMARY KEY (`dict_key`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `Attribute` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `type` enum('string','uint','float','dict','date') DEFAULT NULL,
+        `name` char(64) DEFAULT NULL, PRIMARY KEY (`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `AttributeValue` (
+        `object_id` int(10) unsigned NOT NULL, `object_tid` int(10) unsigned NOT NULL DEFAULT '0',
+        `attr_id` int(10) unsigned NOT NULL, `string_value` char(255) DEFAULT NULL,
+        `uint_value` int(10) unsigned DEFAULT NULL, `float_value` float DEFAULT NULL,
+        PRIMARY KEY (`object_id`,`attr_id`), KEY `attr_id` (`attr_id`,`uint_value`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `RackSpace` (
+        `rack_id` int(10) unsigned NOT NULL, `unit_no` int(10) unsigned NOT NULL,
+        `atom` enum('front','interior','rear') NOT NULL, `state` enum('A','U','T') NOT NULL DEFAULT 'A',
+        `object_id` int(10) unsigned DEFAULT NULL,
+        PRIMARY KEY (`rack_id`,`unit_no`,`atom`), KEY `RackSpace_object_id` (`object_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `Port` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `object_id` int(10) unsigned NOT NULL,
+        `name` char(255) NOT NULL, `iif_id` int(10) unsigned NOT NULL DEFAULT '1', `type` int(10) unsigned NOT NULL,
+        `l2address` char(64) DEFAULT NULL, `reservation_comment` char(255) DEFAULT NULL, `label` char(255) DEFAULT NULL,
+        PRIMARY KEY (`id`), KEY `object_id` (`object_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `PortOuterInterface` (
+        `id` int(10) unsigned NOT NULL, `oif_name` char(48) NOT NULL, PRIMARY KEY (`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `Link` (
+        `porta` int(10) unsigned NOT NULL, `portb` int(10) unsigned NOT NULL, `cable` char(64) DEFAULT NULL,
+        PRIMARY KEY (`porta`,`portb`), UNIQUE KEY `porta` (`porta`), UNIQUE KEY `portb` (`portb`))
+        ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `EntityLink` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+        `parent_entity_type` enum('location','object','rack','row') NOT NULL, `parent_entity_id` int(10) unsigned NOT NULL,
+        `child_entity_type` enum('location','object','rack','row') NOT NULL, `child_entity_id` int(10) unsigned NOT NULL,
+        PRIMARY KEY (`id`), KEY `child` (`child_entity_type`,`child_entity_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv4Network` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `ip` int(10) unsigned NOT NULL DEFAULT '0',
+        `mask` int(10) unsigned NOT NULL DEFAULT '0', `name` char(255) DEFAULT NULL, `comment` text,
+        PRIMARY KEY (`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv4Address` (
+        `ip` int(10) unsigned NOT NULL DEFAULT '0', `name` char(255) NOT NULL DEFAULT '',
+        `comment` char(255) NOT NULL DEFAULT '', `reserved` enum('yes','no') DEFAULT NULL,
+        PRIMARY KEY (`ip`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv4Allocation` (
+        `object_id` int(10) unsigned NOT NULL DEFAULT '0', `ip` int(10) unsigned NOT NULL DEFAULT '0',
+        `name` char(255) NOT NULL DEFAULT '',
+        `type` enum('regular','shared','virtual','router','point2point','sharedrouter') NOT NULL DEFAULT 'regular',
+        PRIMARY KEY (`object_id`,`ip`), KEY `ip` (`ip`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv6Network` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `ip` binary(16) NOT NULL, `mask` int(10) unsigned NOT NULL,
+        `last_ip` binary(16) NOT NULL, `name` char(255) DEFAULT NULL, `comment` text,
+        PRIMARY KEY (`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv6Address` (
+        `ip` binary(16) NOT NULL, `name` char(255) NOT NULL DEFAULT '',
+        `comment` char(255) NOT NULL DEFAULT '', `reserved` enum('yes','no') DEFAULT NULL,
+        PRIMARY KEY (`ip`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv6Allocation` (
+        `object_id` int(10) unsigned NOT NULL DEFAULT '0', `ip` binary(16) NOT NULL,
+        `name` char(255) NOT NULL DEFAULT '',
+        `type` enum('regular','shared','virtual','router','point2point','sharedrouter') NOT NULL DEFAULT 'regular',
+        PRIMARY KEY (`object_id`,`ip`), KEY `ip` (`ip`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `ObjectHistory` (
+        `id` int(10) unsigned DEFAULT NULL, `name` char(255) DEFAULT NULL, `label` char(255) DEFAULT NULL,
+        `objtype_id` int(10) unsigned DEFAULT NULL, `asset_no` char(64) DEFAULT NULL,
+        `has_problems` enum('yes','no') NOT NULL DEFAULT 'no', `comment` text,
+        `ctime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, `user_name` char(64) DEFAULT NULL,
+        KEY `id` (`id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `ObjectLog` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `object_id` int(10) unsigned NOT NULL,
+        `user` char(64) NOT NULL, `date` datetime NOT NULL, `content` text NOT NULL,
+        PRIMARY KEY (`id`), KEY `object_id` (`object_id`), KEY `date` (`date`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `MountOperation` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `object_id` int(10) unsigned NOT NULL,
+        `ctime` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, `user_name` char(64) DEFAULT NULL,
+        `old_molecule_id` int(10) unsigned DEFAULT NULL, `new_molecule_id` int(10) unsigned DEFAULT NULL,
+        `comment` text, PRIMARY KEY (`id`), KEY `object_id` (`object_id`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `PortLog` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `port_id` int(10) unsigned NOT NULL,
+        `date` datetime NOT NULL, `user` varchar(64) NOT NULL, `message` text NOT NULL,
+        PRIMARY KEY (`id`), KEY `port_id-date` (`port_id`,`date`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv4Log` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `ip` int(10) unsigned NOT NULL,
+        `date` datetime NOT NULL, `user` varchar(64) NOT NULL, `message` text NOT NULL,
+        PRIMARY KEY (`id`), KEY `ip-date` (`ip`,`date`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE TABLE IF NOT EXISTS `IPv6Log` (
+        `id` int(10) unsigned NOT NULL AUTO_INCREMENT, `ip` binary(16) NOT NULL,
+        `date` datetime NOT NULL, `user` varchar(64) NOT NULL, `message` text NOT NULL,
+        PRIMARY KEY (`id`), KEY `ip-date` (`ip`,`date`)) ENGINE=InnoDB DEFAULT CHARSET=utf8""",
+    """CREATE OR REPLACE VIEW `Location` AS SELECT O.id, O.name, O.has_problems, O.comment,
+        P.id AS parent_id, P.name AS parent_name
+        FROM `Object` O
+        LEFT JOIN (`Object` P INNER JOIN `EntityLink` EL
+            ON EL.parent_entity_id = P.id AND P.objtype_id = 1562 AND EL.parent_entity_type = 'location'
+            AND EL.child_entity_type = 'location')
+        ON EL.child_entity_id = O.id
+        WHERE O.objtype_id = 1562""",
+    """CREATE OR REPLACE VIEW `Row` AS SELECT O.id, O.name, L.id AS location_id, L.name AS location_name
+        FROM `Object` O
+        LEFT JOIN `EntityLink` EL ON O.id = EL.child_entity_id AND EL.parent_entity_type = 'location'
+            AND EL.child_entity_type = 'row'
+        LEFT JOIN `Object` L ON EL.parent_entity_id = L.id AND L.objtype_id = 1562
+        WHERE O.objtype_id = 1561""",
+    """CREATE OR REPLACE VIEW `Rack` AS SELECT O.id, O.name, O.asset_no, O.has_problems, O.comment,
+        AV_H.uint_value AS height, R.id AS row_id, R.name AS row_name, L.id AS location_id, L.name AS location_name
+        FROM `Object` O
+        LEFT JOIN `AttributeValue` AV_H ON O.id = AV_H.object_id AND AV_H.attr_id = 27
+        LEFT JOIN `EntityLink` RL ON O.id = RL.child_entity_id AND RL.parent_entity_type = 'row'
+            AND RL.child_entity_type = 'rack'
+        INNER JOIN `Object` R ON R.id = RL.parent_entity_id
+        LEFT JOIN `EntityLink` LL ON R.id = LL.child_entity_id AND LL.parent_entity_type = 'location'
+            AND LL.child_entity_type = 'row'
+        LEFT JOIN `Object` L ON L.id = LL.parent_entity_id
+        WHERE O.objtype_id = 1560""",
+)
+
+
+class Writer:
+    """
+    Buffers rows per table and inserts them in batches.
+    When a table's batch is full, all tables are flushed in COLUMNS order, so that no row is inserted
+    before the rows it refers to.
+    """
+
+    def __init__(self, con, batch=1000):
+        self.con = con
+        self.batch = batch
+        self.rows = dict((table, []) for table in COLUMNS)
+        self.counts = dict((table, 0) for table in COLUMNS)
+
+    def add(self, table, *row):
+        self.rows[table].append(row)
+        if len(self.rows[table]) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        for name in COLUMNS:
+            rows = self.rows[name]
+            if not rows:
+                continue
+            columns = COLUMNS[name]
+            q = 'INSERT %sINTO `%s` (%s) VALUES (%s)' % ('IGNORE ' if name in REFERENCE_TABLES else '', name,
+                                                        ', '.join('`%s`' % c for c in columns),
+                                                        ', '.join(['%s'] * len(columns)))
+            cur = self.con.cursor()
+            cur.executemany(q, rows)
+            self.con.commit()
+            self.counts[name] += len(rows)
+            self.rows[name] = []
+
+
+def timestamp(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+def ipv6(network, host):
+    """
+    :return: address `host` of /64 number `network` below IPV6_PREFIX, as RT stores it (16 bytes)
+    """
+    return struct.pack('!HHHHQ', IPV6_PREFIX[0], IPV6_PREFIX[1], network >> 16, network & 0xffff, host)
+
+
+class Generator:
+    """
+    :param objects: number of devices to generate (racks, rows and locations come on top)
+    :param seed: random seed, same seed and size give the same dataset
+    :param link_density: share of server ports that are cabled to a switch
+    :param dict_key: highest Dictionary key in use, generated entries come after it
+    """
+
+    def __init__(self, writer, objects, seed, link_density, dict_key=LAST_STOCK_DICT_KEY):
+        self.w = writer
+        self.dict_key = dict_key
+        self.objects = objects
+        self.rnd = random.Random(seed)
+        self.link_density = link_density
+        self.next_id = 0
+        self.next_port = 0
+        self.next_ip = 0
+        self.models = {}  # objtype -> list of (dict_key, height)
+        self.os_keys = []
+        self.racks = []  # [rack id, next free unit]
+        self.switch_ports = []  # free switch port ids
+        self.networks = []
+        self.named = set()  # addresses with a name
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def now(self):
+        return timestamp(HISTORY_START + self.next_id)
+
+    def add_object(self, objtype, prefix, comment=None):
+        object_id = self.new_id()
+        name = '%s%06d' % (prefix, object_id)
+        if objtype not in (RACK, ROW, LOCATION) and self.rnd.random() < UNNAMED_SHARE:
+            name = None
+        asset = 'A%08d' % object_id if self.rnd.random() < 0.5 else None
+        self.w.add('Object', object_id, name, '', objtype, asset, comment)
+        self.w.add('ObjectHistory', object_id, name, '', objtype, asset, comment, self.now(), 'datagen')
+        return object_id
+
+    def link(self, parent_type, parent_id, child_type, child_id):
+        self.w.add('EntityLink', parent_type, parent_id, child_type, child_id)
+
+    def dictionary(self):
+        dict_key = self.dict_key
+        for attr in ((2, 'dict', 'HW type'), (3, 'string', 'FQDN'), (4, 'dict', 'SW type'),
+                     (6, 'uint', 'number of ports'), (27, 'uint', 'Height, units')):
+            self.w.add('Attribute', *attr)
+        for oif in PORT_TYPES:
+            self.w.add('PortOuterInterface', *oif)
+
+        for objtype, vendors in sorted(VENDORS.items()):
+            self.models[objtype] = []
+            for vendor, model, heights in vendors:
+                for n in range(self.rnd.randint(3, 12)):
+                    dict_key += 1
+                    height = self.rnd.choice(heights)
+                    name = model % self.rnd.randint(10, 9999)
+                    # RT notation: '%GPASS%' separates vendor and model, some entries are just 'vendor model'
+                    value = '%s%%GPASS%%%s' % (vendor, name) if self.rnd.random() < 0.7 else '%s %s' % (vendor, name)
+                    self.w.add('Dictionary', 11, dict_key, value)
+                    self.models[objtype].append((dict_key, height))
+        for value in OPERATING_SYSTEMS:
+            dict_key += 1
+            self.w.add('Dictionary', 13, dict_key, value)
+            self.os_keys.append(dict_key)
+
+    def infrastructure(self):
+        racks = max(1, self.objects // OBJECTS_PER_RACK)
+        locations = []
+        for n in range(max(1, racks // 200)):
+            location_id = self.add_object(LOCATION, 'DC')
+            locations.append(location_id)
+            # sub-locations (rooms or cages)
+            for m in range(self.rnd.randint(0, 2)):
+                child_id = self.add_object(LOCATION, 'Room')
+                self.link('location', location_id, 'location', child_id)
+                locations.append(child_id)
+
+        row_id = None
+        for n in range(racks):
+            if n % RACKS_PER_ROW == 0:
+                row_id = self.add_object(ROW, 'Row')
+                self.link('location', self.rnd.choice(locations), 'row', row_id)
+            rack_id = self.add_object(RACK, 'Rack')
+            self.w.add('AttributeValue', rack_id, RACK, 27, None, RACK_HEIGHT)
+            self.link('row', row_id, 'rack', rack_id)
+            self.racks.append([rack_id, 1])
+
+    def mount(self, object_id, height, depth=1):
+        """
+        Put an object into the first rack with enough free space, starting at a random rack.
+        :param depth: 1 full depth, 2 half depth (front and interior), 3 rear only
+        """
+        if not height:
+            return None
+        start = self.rnd.randrange(len(self.racks))
+        for n in range(len(self.racks)):
+            rack = self.racks[(start + n) % len(self.racks)]
+            if rack[1] + height - 1 <= RACK_HEIGHT:
+                atoms = {1: ('front', 'interior', 'rear'), 2: ('front', 'interior'), 3: ('rear',)}[depth]
+                for unit in range(rack[1], rack[1] + height):
+                    for atom in atoms:
+                        self.w.add('RackSpace', rack[0], unit, atom, 'T', object_id)
+                self.w.add('MountOperation', object_id, self.now(), 'datagen', None)
+                rack[1] += height
+                return rack[0]
+        return None
+
+    def add_ports(self, object_id, count, prefix='eth', oif=24):
+        ports = []
+        for n in range(count):
+            self.next_port += 1
+            mac = None
+            if self.rnd.random() < 0.6:
+                mac = ''.join('%02X' % self.rnd.randint(0, 255) for x in range(6))
+            self.w.add('Port', self.next_port, object_id, '%s%d' % (prefix, n), 1, oif, mac, '')
+            ports.append(self.next_port)
+        return ports
+
+    def cable(self, porta, portb):
+        cable = 'C%07d' % porta if self.rnd.random() < 0.5 else None
+        self.w.add('Link', porta, portb, cable)
+        for port in (porta, portb):
+            self.w.add('PortLog', port, self.now(), 'datagen', 'linked')
+
+    def connect(self, ports):
+        for port in ports:
+            if self.switch_ports and self.rnd.random() < self.link_density:
+                self.cable(port, self.switch_ports.pop(self.rnd.randrange(len(self.switch_ports))))
+
+    def allocate_ip(self, object_id, nic='eth0'):
+        n = self.next_ip // 250 % len(self.networks)
+        network = self.networks[n]
+        ip = network + 1 + self.next_ip % 250
+        self.next_ip += 1
+        self.w.add('IPv4Allocation', object_id, ip, nic, 'regular')
+        self.w.add('IPv4Log', ip, self.now(), 'datagen', 'allocated to %d' % object_id)
+        if self.rnd.random() < 0.3 and ip not in self.named:
+            self.named.add(ip)
+            self.w.add('IPv4Address', ip, 'addr-%d' % ip, '', 'no')
+        # IPv6 without random numbers, so that the IPv4 data of a seed stays the same
+        if self.next_ip % IPV6_EVERY == 0:
+            ip6 = ipv6(n, self.next_ip)
+            self.w.add('IPv6Allocation', object_id, ip6, nic, 'regular')
+            self.w.add('IPv6Log', ip6, self.now(), 'datagen', 'allocated to %d' % object_id)
+            if self.next_ip % (3 * IPV6_EVERY) == 0:
+                self.w.add('IPv6Address', ip6, 'addr6-%d' % self.next_ip, '', 'no')
+
+    def hardware(self, object_id, objtype):
+        dict_key, height = self.rnd.choice(self.models[objtype])
+        # RT does not enforce model heights, some devices of a model take more space
+        if height and self.rnd.random() < 0.02:
+            height += 1
+        self.w.add('AttributeValue', object_id, objtype, 2, None, dict_key)
+        return height
+
+    def devices(self):
+        counts = dict((objtype, int(round(self.objects * share))) for objtype, share in MIX)
+        blades = int(round(self.objects * BLADE_SHARE))
+
+        for n in range(max(1, self.objects // 150)):
+            network = (10 << 24) + (n << 8)
+            self.w.add('IPv4Network', n + 1, network, 24, 'net-%d' % n, None)
+            self.w.add('IPv6Network', n + 1, ipv6(n, 0), 64, ipv6(n, 2 ** 64 - 1), 'net6-%d' % n, None)
+            self.networks.append(network)
+
+        # network gear first, so that servers can be cabled to it
+        for objtype in (SWITCH, ROUTER, KVM, FC_SWITCH, CONSOLE):
+            for n in range(counts[objtype]):
+                object_id = self.add_object(objtype, 'net')
+                self.mount(object_id, self.hardware(object_id, objtype))
+                ports = self.add_ports(object_id, self.rnd.choice((24, 48)), 'ge-0/0/', self.rnd.choice(PORT_TYPES)[0])
+                if objtype == SWITCH:
+                    self.switch_ports.extend(ports)
+                else:
+                    self.connect(ports[:2])
+                self.allocate_ip(object_id, 'mgmt0')
+
+        for n in range(counts[PATCH_PANEL]):
+            object_id = self.add_object(PATCH_PANEL, 'pp')
+            size = self.rnd.choice((24, 48))
+            self.w.add('AttributeValue', object_id, PATCH_PANEL, 6, None, size)
+            self.mount(object_id, self.hardware(object_id, PATCH_PANEL))
+            # most patch panels have one port type, some are modular
+            ports = self.add_ports(object_id, size, 'port', self.rnd.choice(PORT_TYPES)[0])
+            if self.rnd.random() < 0.2:
+                ports += self.add_ports(object_id, 4, 'uplink', self.rnd.choice(PORT_TYPES)[0])
+            for port in ports:
+                if self.switch_ports and self.rnd.random() < self.link_density / 2:
+                    self.cable(port, self.switch_ports.pop(self.rnd.randrange(len(self.switch_ports))))
+
+        hosts = []
+        for n in range(counts[VM_HOST]):
+            object_id = self.add_object(VM_HOST, 'esx')
+            self.w.add('AttributeValue', object_id, VM_HOST, 4, None, self.rnd.choice(self.os_keys))
+            hosts.append(object_id)
+
+        chassis = []
+        for n in range(counts[CHASSIS]):
+            object_id = self.add_object(CHASSIS, 'chassis')
+            self.mount(object_id, self.hardware(object_id, CHASSIS))
+            chassis.append(object_id)
+
+        for n in range(counts[SERVER]):
+            object_id = self.add_object(SERVER, 'srv', 'generated server\n&lt;test&gt;' if n % 10 == 0 else None)
+            self.w.add('AttributeValue', object_id, SERVER, 4, None, self.rnd.choice(self.os_keys))
+            height = self.hardware(object_id, SERVER)
+            if self.rnd.random() < 0.9:
+                self.mount(object_id, height, self.rnd.choice((1, 1, 1, 2)))
+            self.connect(self.add_ports(object_id, self.rnd.choice((2, 2, 4))))
+            self.allocate_ip(object_id)
+
+        for n in range(blades):
+            object_id = self.add_object(SERVER, 'blade')
+            self.hardware(object_id, SERVER)
+            if chassis:
+                self.link('object', self.rnd.choice(chassis), 'object', object_id)
+            self.connect(self.add_ports(object_id, 2))
+            self.allocate_ip(object_id)
+
+        for n in range(counts[VM]):
+            object_id = self.add_object(VM, 'vm')
+            self.w.add('AttributeValue', object_id, VM, 4, None, self.rnd.choice(self.os_keys))
+            if hosts:
+                self.link('object', self.rnd.choice(hosts), 'object', object_id)
+            self.allocate_ip(object_id)
+
+        for n in range(counts[PDU]):
+            object_id = self.add_object(PDU, 'pdu')
+            height = self.hardware(object_id, PDU)
+            if height:
+                self.mount(object_id, height, 3)
+            else:
+                # Zero-U
+                self.link('rack', self.rnd.choice(self.racks)[0], 'object', object_id)
+            self.add_ports(object_id, 8, 'outlet', 681)
+
+        # a few named addresses that are not allocated to any object
+        for n in range(min(max(1, self.objects // 100), len(self.networks) * 4)):
+            self.w.add('IPv4Address', self.networks[n % len(self.networks)] + 251 + n // len(self.networks),
+                       'reserved-%d' % n, '', 'yes')
+
+    def run(self):
+        self.dictionary()
+        self.infrastructure()
+        self.devices()
+        self.w.flush()
+
+
+def change(con, count, seed):
+    """
+    Edit `count` random named objects the way a user would: new comment, ObjectHistory and ObjectLog entries
+    and, for some of them, a renamed port and a changed IPv4 address, all with the current time.
+    Used to test --incremental runs.
+    """
+    rnd = random.Random(seed)
+    now = timestamp(time.time())
+    cur = con.cursor()
+    cur.execute('SELECT id, name, label, objtype_id, asset_no FROM Object WHERE name IS NOT NULL')
+    objects = rnd.sample(cur.fetchall(), count)
+    for object_id, name, label, objtype, asset in objects:
+        comment = 'changed by datagen at %s' % now
+        cur.execute('UPDATE Object SET comment = %s WHERE id = %s', (comment, object_id))
+        cur.execute('INSERT INTO ObjectHistory (id, name, label, objtype_id, asset_no, comment, ctime, user_name) '
+                    'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', (object_id, name, label, objtype, asset, comment, now,
+                                                                 'datagen'))
+        cur.execute('INSERT INTO ObjectLog (object_id, user, date, content) VALUES (%s, %s, %s, %s)',
+                    (object_id, 'datagen', now, comment))
+        if rnd.random() < 0.3:
+            cur.execute('SELECT id FROM Port WHERE object_id = %s LIMIT 1', (object_id,))
+            port = cur.fetchone()
+            if port:
+                cur.execute('UPDATE Port SET label = %s WHERE id = %s', ('changed', port[0]))
+                cur.execute('INSERT INTO PortLog (port_id, date, user, message) VALUES (%s, %s, %s, %s)',
+                            (port[0], now, 'datagen', 'label changed'))
+        if rnd.random() < 0.3:
+            cur.execute('SELECT ip FROM IPv4Allocation WHERE object_id = %s LIMIT 1', (object_id,))
+            ip = cur.fetchone()
+            if ip:
+                cur.execute('DELETE FROM IPv4Address WHERE ip = %s', (ip[0],))
+                cur.execute('INSERT INTO IPv4Address (ip, name, comment, reserved) VALUES (%s, %s, %s, %s)',
+                            (ip[0], 'changed-%d' % ip[0], '', 'no'))
+                cur.execute('INSERT INTO IPv4Log (ip, date, user, message) VALUES (%s, %s, %s, %s)',
+                            (ip[0], now, 'datagen', 'name changed'))
+    con.commit()
+    return len(objects)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a RackTables database with synthetic data')
+    parser.add_argument('--objects', type=int, default=1000, help='number of devices, default 1000')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, default 1')
+    parser.add_argument('--link-density', type=float, default=0.7,
+                        help='share of server ports cabled to a switch, default 0.7')
+    parser.add_argument('--create-schema', action='store_true', help='create missing tables and views')
+    parser.add_argument('--clear', action='store_true',
+                        help='delete existing objects, ports, addresses and their history, reference data '
+                             '(Attribute, Dictionary, PortOuterInterface) is kept')
+    parser.add_argument('--change', type=int, metavar='N',
+                        help='edit N random objects of an existing dataset instead of generating one')
+    args = parser.parse_args()
+
+    conf = imp.load_source('conf', 'conf')
+    con = sql.connect(host=conf.DB_IP, port=int(conf.DB_PORT),
+                      db=conf.DB_NAME, user=conf.DB_USER, passwd=conf.DB_PWD)
+    cur = con.cursor()
+    if args.create_schema:
+        for q in SCHEMA:
+            cur.execute(q)
+    if args.clear:
+        for table in reversed(COLUMNS):
+            if table not in REFERENCE_TABLES:
+                cur.execute('DELETE FROM `%s`' % table)
+        con.commit()
+    if args.change:
+        print '[!] Changed %d objects' % change(con, args.change, args.seed)
+        return
+    cur.execute('SELECT COUNT(*) FROM Object')
+    if cur.fetchone()[0]:
+        print '[!] Object table of %s is not empty, use --clear to replace its data' % conf.DB_NAME
+        sys.exit(1)
+
+    cur.execute('SELECT MAX(dict_key) FROM Dictionary')
+    dict_key = max(cur.fetchone()[0], LAST_STOCK_DICT_KEY)
+
+    start = time.time()
+    writer = Writer(con)
+    Generator(writer, args.objects, args.seed, args.link_density, dict_key).run()
+    print '[!] Generated in %.1fs:' % (time.time() - start)
+    for table in sorted(writer.counts):
+        print '    %-20s %10d rows' % (table, writer.counts[table])
+
+
+if __name__ == '__main__':
+    main()